@@ -0,0 +1,145 @@
+#!/usr/local/bin/python3
+# runs a directory of CaaS queries at once over one shared client
+# 10/18/26
+# updated 10/18/26
+
+'''
+runs every query spec in a directory concurrently, each into its own output file:
+
+python3 batch_query.py config/queries
+
+a query spec is a json file holding an elasticsearch request, just like
+config/elastic_search_request.json, and its file name is the name of the query.
+config/queries/hair.json is written to output/hair.csv (see --output-dir and --format).
+the other search params come from config/query_config.json, same as caas_query.py.
+
+every query is run by caas_query.export_query() (or export_incremental() with
+--incremental), and they all share one AsyncCaaSClient: one connection pool and
+concurrency limit, one rate limiter, one entity cache and one set of metrics.
+nlp records that several queries need are fetched once, either from the cache or
+by waiting on the get_batch() that's already fetching them. entities that match
+more than one query still come back in each query's search pages, since that's
+how the pages are built.
+
+a query that fails doesn't stop the others. its checkpoint is left behind, and
+it can be resumed on its own with caas_query.py --resume, or with this script's
+--resume, which resumes every query that has a checkpoint.
+'''
+
+import os
+import sys
+import asyncio
+import argparse
+import caas_query
+from utils import client_wrapper, entity_cache, sinks
+from utils.checkpoint import Checkpoint
+from utils.dedupe import DedupeStore
+from utils.metrics import Metrics
+
+output_dir = 'output'
+
+
+def read_specs(spec_dir):
+    '''return a dict formatted as name: path of the json query specs in spec_dir, in name order'''
+    names = sorted(name for name in os.listdir(spec_dir) if name.endswith('.json'))
+    if not names:
+        raise SystemExit('no .json query specs found in {}'.format(spec_dir))
+
+    return {name[:-len('.json')]: os.path.join(spec_dir, name) for name in names}
+
+
+async def export_spec(caas_client, name, spec_path, output, training_urls, args):
+    '''export one query spec into output, on the shared client'''
+    elastic_request = caas_client._construct_elastic_request(spec_path)
+    dedupe = DedupeStore(spill=args.dedupe, logger=caas_query.logger)
+    resume = args.resume and os.path.isfile(output + Checkpoint.suffix)
+
+    caas_query.logger.info('{}: exporting to {}{}'.format(name, output, ' (resuming)' if resume else ''))
+    if args.incremental:
+        await caas_query.export_incremental(caas_client, output, training_urls, slices=args.slices, dedupe=dedupe,
+                                            elastic_request=elastic_request)
+    else:
+        if not resume:
+            caas_query._init_output_file(output)
+        await caas_query.export_query(caas_client, output, training_urls, resume=resume, slices=args.slices,
+                                      dedupe=dedupe, elastic_request=elastic_request)
+    caas_query.logger.info('{}: done'.format(name))
+
+
+async def run_batch(caas_client, specs, training_urls, args):
+    '''
+    run every spec at once, or at most args.parallel of them at a time.
+    return a dict formatted as name: exception of the queries that failed
+    '''
+    semaphore = asyncio.Semaphore(args.parallel or len(specs))
+
+    async def run(name, spec_path):
+        async with semaphore:
+            output = os.path.join(args.output_dir, name + args.format)
+            await export_spec(caas_client, name, spec_path, output, training_urls, args)
+
+    async with caas_client:
+        results = await asyncio.gather(*[run(name, spec_path) for name, spec_path in specs.items()],
+                                       return_exceptions=True)
+
+    return {name: result for name, result in zip(specs, results) if isinstance(result, BaseException)}
+
+
+def capture_args():
+    parser = argparse.ArgumentParser(description='run a directory of CaaS queries at once, each into its own output file')
+    parser.add_argument('spec_dir', help='directory of json elasticsearch requests, one per query, named after the query')
+    parser.add_argument('--output-dir', default=output_dir, help='directory to write <query name><format> files to')
+    parser.add_argument('--format', choices=[sinks.CsvSink.extension, sinks.ParquetSink.extension],
+                        default=sinks.CsvSink.extension, help='output format to write')
+    parser.add_argument('--parallel', type=int, default=0, help='queries to run at once, all of them by default')
+    parser.add_argument('--slices', type=int, default=1, help='$date windows to split each query into')
+    parser.add_argument('--concurrency', type=int, default=client_wrapper.AsyncCaaSClient.max_concurrency * 2,
+                        help='requests the shared client keeps in flight at once, across every query')
+    parser.add_argument('--dedupe', choices=DedupeStore.spills, default='disk',
+                        help='where seen caas ids go once there are too many to keep in memory')
+    parser.add_argument('--resume', action='store_true', help='resume the queries that have a checkpoint, start the rest')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export what is new since the last incremental run of each query, see caas_query.py')
+    parser.add_argument('--follow-nlp', action='store_true',
+                        help='have CaaS follow the nlp edges inside each search, instead of fetching them with get_batch')
+    parser.add_argument('--metrics', help='file to save request and stage timings of the whole batch to')
+    args = parser.parse_args()
+
+    if args.incremental and args.resume:
+        parser.error("incremental runs can't be resumed, run again to pick up from the last watermark")
+    if args.format != sinks.CsvSink.extension and (args.incremental or args.resume):
+        parser.error('only csv output can be resumed or updated incrementally')
+
+    return args
+
+
+if __name__ == '__main__':
+    caas_query.logger = caas_query.configure_logger()
+    args = capture_args()
+    specs = read_specs(args.spec_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    training_urls = caas_query.get_existing_urls()
+    cache = entity_cache.EntityCache(path=caas_query.cache_path)
+    metrics = Metrics()
+    caas_client = client_wrapper.AsyncCaaSClient(
+        elastic_path=caas_query.elastic_path, query_config_path=caas_query.query_config_path,
+        logger=caas_query._initialize_logger('caas_client'), cache=cache, max_concurrency=args.concurrency,
+        metrics=metrics, entity_fields=caas_query.QueryData.entity_fields,
+        follow=list(caas_query.QueryData.nlp_edges.values()) if args.follow_nlp else None)
+
+    caas_query.logger.info('running {} queries: {}'.format(len(specs), ', '.join(specs)))
+    try:
+        failed = asyncio.run(run_batch(caas_client, specs, training_urls, args))
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+
+    caas_query.logger.info('entity cache hits: {hits}, misses: {misses}'.format(**cache.stats()))
+    cache.close()
+    training_urls.close()
+
+    for name, error in failed.items():
+        caas_query.logger.error('{} failed: {!r}'.format(name, error))
+    if failed:
+        sys.exit('{} of {} queries failed'.format(len(failed), len(specs)))
@@ -0,0 +1,181 @@
+#!/usr/local/bin/python3
+# end to end throughput benchmark of caas_query.py against a local mock of CaaS
+# 10/18/26
+# updated 10/18/26
+
+'''
+runs the whole caas_query.py pipeline (search, nlp enrichment, dedupe, filtering
+and writing) against utils/mock_caas.py and reports how fast it went:
+
+python3 benchmark.py --entities 20000 --latency 0.05 --slices 4 --runs 3
+
+for each run it prints the wall time, pages/sec and entities/sec searched, and the
+p50/p99 round trip times of the search and get_batch requests, the mean size of a
+search response and the share of searches decoded as a stream, then the median of
+every number across the runs. the mock serves the same generated entities every
+time, so numbers from before and after a change can be compared directly. an untimed
+warmup run goes first, so the mock has already matched the query before anything's timed.
+--json saves the results, so they can be kept alongside the change. --full-entities
+turns off field projection, to see what it saves.
+
+--nlp picks how the nlp records are fetched: 'batch' looks them up with get_batch
+after each search page, 'follow' has the search follow the nlp edges itself, and
+'both' does the runs once with each and prints their medians side by side:
+
+python3 benchmark.py --entities 20000 --latency 0.05 --nlp both
+'''
+
+import os
+import math
+import json
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import caas_query
+from time import monotonic
+from statistics import median
+from utils import client_wrapper, entity_cache, mock_caas
+from utils.metrics import Metrics
+from utils.dedupe import DedupeStore
+from utils.rate_limiter import AdaptiveRateLimiter
+
+elastic_path = 'config/elastic_search_request.json'
+query_config_path = 'config/query_config.json'
+
+
+def percentile(values, percent):
+    '''nearest-rank percentile of values, 0 if there aren't any'''
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def write_elastic_request(path, size):
+    '''copy our elastic request to path with its page size set to size'''
+    with open(elastic_path) as conf:
+        elastic_request = json.load(conf)
+
+    elastic_request['size'] = size
+    with open(path, 'w') as conf:
+        json.dump(elastic_request, conf)
+
+    return path
+
+
+def run_once(url, args, workdir, logger, nlp='batch'):
+    entity_client = mock_caas.MockEntityClient(url)
+    metrics = Metrics()
+    cache = entity_cache.EntityCache(path=os.path.join(workdir, 'entity_cache.sqlite')) if args.cache else None
+    caas_client = client_wrapper.AsyncCaaSClient(
+        elastic_path=write_elastic_request(os.path.join(workdir, 'elastic_search_request.json'), args.size),
+        query_config_path=query_config_path, logger=logger, cache=cache,
+        rate_limiter=AdaptiveRateLimiter(rate=args.rate, max_rate=args.rate, logger=logger),
+        max_concurrency=args.concurrency, entity_client=entity_client, metrics=metrics,
+        entity_fields=None if args.full_entities else caas_query.QueryData.entity_fields,
+        follow=list(caas_query.QueryData.nlp_edges.values()) if nlp == 'follow' else None)
+
+    output = os.path.join(workdir, 'results' + args.format)
+    caas_query._init_output_file(output)
+
+    start = monotonic()
+    asyncio.run(caas_query.run_query(caas_client, output, set(), slices=args.slices, dedupe=DedupeStore(logger=logger)))
+    elapsed = monotonic() - start
+
+    if cache:
+        cache.close()
+
+    searches = entity_client.timings['search']
+    batches = entity_client.timings['get_batch']
+    summary = metrics.to_dict()
+    response_bytes = summary['histograms'].get('caas_response_bytes{operation="search"}', {})
+    decodes = {streamed: summary['counters'].get('caas_search_decodes_total{{streamed="{}"}}'.format(streamed), 0)
+               for streamed in ['true', 'false']}
+    return {
+        'seconds': elapsed,
+        'pages': len(searches),
+        'entities': entity_client.entities['search'],
+        'pages_per_second': len(searches) / elapsed,
+        'entities_per_second': entity_client.entities['search'] / elapsed,
+        'search_p50_ms': percentile(searches, 50) * 1000,
+        'search_p99_ms': percentile(searches, 99) * 1000,
+        'get_batch_requests': len(batches),
+        'get_batch_p50_ms': percentile(batches, 50) * 1000,
+        'get_batch_p99_ms': percentile(batches, 99) * 1000,
+        'requests_per_page': (len(searches) + len(batches)) / max(len(searches), 1),
+        'search_kb': (response_bytes.get('mean') or 0) / 1024,
+        'streamed_percent': 100 * decodes['true'] / max(sum(decodes.values()), 1)
+    }
+
+
+def print_result(label, result):
+    print('{:>7}  {seconds:7.2f}s  {pages:5.0f} pages  {pages_per_second:8.1f} pages/s  {entities_per_second:9.1f} entities/s  '
+          'search p50/p99 {search_p50_ms:6.1f}/{search_p99_ms:6.1f}ms  '
+          'get_batch p50/p99 {get_batch_p50_ms:6.1f}/{get_batch_p99_ms:6.1f}ms  {search_kb:7.1f}kb/search  '
+          '{requests_per_page:4.2f} requests/page  {streamed_percent:3.0f}% streamed'.format(label, **result))
+
+
+def capture_args():
+    parser = argparse.ArgumentParser(description='benchmark caas_query.py end to end against a local mock of CaaS')
+    parser.add_argument('--entities', type=int, default=10000, help='how many articles the mock serves')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated articles')
+    parser.add_argument('--fixture', help='json file with a list of entities to serve instead of generated ones')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the mock delays every response by')
+    parser.add_argument('--jitter', type=float, default=0.02, help='up to this many more seconds of random delay')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests the mock answers with a 429')
+    parser.add_argument('--size', type=int, default=100, help='page size of the query')
+    parser.add_argument('--slices', type=int, default=1, help='$date windows to split the query into')
+    parser.add_argument('--concurrency', type=int, default=client_wrapper.AsyncCaaSClient.max_concurrency,
+                        help='requests the client keeps in flight at once')
+    parser.add_argument('--rate', type=float, default=1000, help='requests per second the rate limiter allows')
+    parser.add_argument('--format', choices=['.csv', '.parquet'], default='.csv', help='output format to write')
+    parser.add_argument('--cache', action='store_true', help='use an entity cache, shared across the runs')
+    parser.add_argument('--full-entities', action='store_true', help="search for whole entities, without field projection")
+    parser.add_argument('--nlp', choices=['batch', 'follow', 'both'], default='batch',
+                        help='fetch nlp records with get_batch, by following edges in the search, or benchmark both')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs to do first')
+    parser.add_argument('--json', help='file to save the results of every run to')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = capture_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    logger = logging.getLogger('benchmark')
+    caas_query.logger = logging.getLogger('query')
+
+    entities = mock_caas.load_fixture(args.fixture) if args.fixture else mock_caas.generate_entities(args.entities, args.seed)
+    caas = mock_caas.MockCaaS(entities)
+    server = mock_caas.MockCaaSServer(caas, latency=args.latency, jitter=args.jitter,
+                                      throttle_rate=args.throttle_rate).start()
+    workdir = tempfile.mkdtemp(prefix='caas_benchmark_')
+
+    print('{} articles, {}s latency, page size {}, {} slices, concurrency {}'.format(
+        len(caas.articles), args.latency, args.size, args.slices, args.concurrency))
+    strategies = ['batch', 'follow'] if args.nlp == 'both' else [args.nlp]
+    results = {}
+    try:
+        for nlp in strategies:
+            print('nlp: {}'.format(nlp))
+            for run in range(args.warmup):
+                run_once(server.url, args, workdir, logger, nlp)
+
+            results[nlp] = []
+            for run in range(1, args.runs + 1):
+                results[nlp].append(run_once(server.url, args, workdir, logger, nlp))
+                print_result('run {}'.format(run), results[nlp][-1])
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+    for nlp in strategies:
+        print_result(nlp if len(strategies) > 1 else 'median',
+                     {key: median(result[key] for result in results[nlp]) for key in results[nlp][0]})
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'args': vars(args), 'runs': results if len(strategies) > 1 else results[args.nlp]}, json_file, indent=2)
@@ -1,7 +1,7 @@
 # attempts to query legacy Time Inc's content-as-a-service (CaaS) datastore
-# and output results to a csv file if an output file is specified.
+# and output results to a csv or parquet file if an output file is specified.
 # 6/1/18
-# updated 6/27/18
+# updated 10/18/26
 
 '''
 the query that is run by this script is determined by the elasticsearch request
@@ -18,49 +18,102 @@ http://docs-caas.timeincapp.com/#search-and-get-examples
 '''
 
 import os
-import sys
 import csv
+import argparse
 import yaml
+import asyncio
 import logging
 import logging.config
 from collections import namedtuple
-from utils import client_wrapper
+from utils import client_wrapper, entity_cache, sinks, url_index
+from utils.checkpoint import Checkpoint
+from utils.dedupe import DedupeStore
+from utils.metrics import Metrics
+from utils.watermark import Watermarks
 
 elastic_path = 'config/elastic_search_request.json'
 query_config_path = 'config/query_config.json'
 log_file = 'query_log.log'
+cache_path = 'entity_cache.sqlite'
+training_corpus_path = 'utils/Hair_Classification_Training_Corpus_Content_as_of_06262018.csv'
+training_index_path = 'utils/training_corpus_urls.idx'
+
+# how many pages the search can get ahead of enrichment and writing
+prefetch_pages = 2
+
+# an incremental run exports what's new into this file next to its output, then merges it in
+delta_suffix = '.delta.csv'
+
+
+class Record:
+    '''
+    the data we keep for a single entity. __slots__ keeps a page of these a lot
+    smaller than a dict per entity, and its order is the column order of our output
+    '''
+
+    __slots__ = ['brand', 'title', 'url', 'sort_id', 'caas_id', 'cms_id', 'gnlp_id',
+                 'wnlp_id', 'gnlp_categories', 'wnlp_categories']
+
+    def __init__(self, caas_id, sort_id):
+        self.sort_id = sort_id
+        self.caas_id = caas_id
+        self.cms_id = ''
+        self.title = ''
+        self.url = ''
+        self.brand = ''
+        self.gnlp_id = ''
+        self.wnlp_id = ''
+        self.gnlp_categories = {}
+        self.wnlp_categories = {}
+
+    def row(self):
+        return [getattr(self, name) for name in self.__slots__]
 
 
 class QueryData:
-    '''class to extract, parse, and hold the specific data we're interested in from a CaaS query'''
-
-    # our csv writer uses these to write the header row to our csv output file
-    fieldnames = ['brand', 'title', 'url', 'sort_id', 'caas_id', 'cms_id', 'gnlp_id',
-                  'wnlp_id', 'gnlp_categories', 'wnlp_categories']
-
-    def __init__(self, entities, hits):
-        self.entities = entities
-        self.hits = hits
-        self.records = self._init_records()
-        self._extract_caas_data()
-
-    def _init_records(self):
-        return {
-            self.entities[i]['$']['id']: {
-                'sort_id': self.hits[i]['sort'],
-                'caas_id': self.entities[i]['$']['id'],
-                'cms_id': '',
-                'title': '',
-                'url': '',
-                'brand': '',
-                'gnlp_id': '',
-                'wnlp_id': '',
-                'gnlp_categories': {},
-                'wnlp_categories': {}
-            } for i in range(len(self.entities))
-        }
-
-    def _extract_caas_data(self):
+    '''
+    class to extract, parse, and hold the specific data we're interested in from a CaaS query.
+
+    self.records holds a Record for every entity in the page, in the order they were
+    returned. records are never removed, filtering just clears their flag in self.keep,
+    and kept() iterates over the ones that are left.
+
+    follow is the list of edges the client asked the search to follow (see --follow-nlp).
+    the nlp records CaaS embedded in those edges are kept in self.followed by their id
+    until get_nlp_data().
+    '''
+
+    # our output sinks use these to write the header row (or schema) of our output file
+    fieldnames = Record.__slots__
+
+    # the entity fields _extract_caas_data() reads each of our output fields from.
+    # keep this in step with it: searches only ask CaaS for these fields, and cut
+    # the entities they return down to them as they're decoded
+    sources = {
+        'brand': ['brand'],
+        'title': ['web_article_title', '$name'],
+        'url': ['web_article_url'],
+        'caas_id': ['$'],
+        'cms_id': ['cms_id'],
+        'gnlp_id': ['$i_nlp_source_google'],
+        'wnlp_id': ['$i_nlp_source_watson']
+    }
+    entity_fields = sorted({field for fields in sources.values() for field in fields})
+
+    # nlp ids are looked up with client.get_batch() in batches of at most this many
+    nlp_batch_size = 100
+    nlp_types = ['google', 'watson']
+    # the edge each type of nlp record hangs off, for the client to follow with --follow-nlp
+    nlp_edges = {'google': '$i_nlp_source_google', 'watson': '$i_nlp_source_watson'}
+
+    def __init__(self, entities, hits, follow=()):
+        self.records = [Record(entities[i]['$']['id'], hits[i]['sort']) for i in range(len(entities))]
+        self.keep = bytearray(b'\x01') * len(self.records)
+        self.followed = {}
+        self._extract_caas_data(entities)
+        self._extract_followed_nlp(entities, [edge for edge in self.nlp_edges.values() if edge in follow])
+
+    def _extract_caas_data(self, entities):
         '''
         extract data from a caas record
 
@@ -72,23 +125,47 @@ class QueryData:
         content = entry['web_article_content']
         '''
 
-        for i in range(len(self.entities)):
-            entry = self.entities[i]
-            caas_id = entry['$']['id']
-            self.records[caas_id]['cms_id'] = entry['cms_id'] if 'cms_id' in entry.keys() else None
-            self.records[caas_id]['title'] = entry['web_article_title'].strip() if 'web_article_title' in entry.keys() \
+        for record, entry in zip(self.records, entities):
+            record.cms_id = entry['cms_id'] if 'cms_id' in entry.keys() else None
+            record.title = entry['web_article_title'].strip() if 'web_article_title' in entry.keys() \
                 else entry['$name'] if '$name' in entry.keys() else None
-            self.records[caas_id]['url'] = entry['web_article_url'] if 'web_article_url' in entry.keys() else None
-            self.records[caas_id]['brand'] = entry['brand'] if 'brand' in entry.keys() else None
-            self.records[caas_id]['gnlp_id'] = entry["$i_nlp_source_google"][0]['$id'] if "$i_nlp_source_google" in entry.keys() else None
-            self.records[caas_id]['wnlp_id'] = entry["$i_nlp_source_watson"][0]['$id'] if "$i_nlp_source_watson" in entry.keys() else None
+            record.url = entry['web_article_url'] if 'web_article_url' in entry.keys() else None
+            record.brand = entry['brand'] if 'brand' in entry.keys() else None
+            record.gnlp_id = entry["$i_nlp_source_google"][0]['$id'] if "$i_nlp_source_google" in entry.keys() else None
+            record.wnlp_id = entry["$i_nlp_source_watson"][0]['$id'] if "$i_nlp_source_watson" in entry.keys() else None
+
+    def _extract_followed_nlp(self, entities, edges):
+        '''
+        a followed edge comes back as the entity it points to, merged into the
+        edge's {'$id': ...}. an edge only counts as followed if it holds that entity's
+        '$' block or its 'nlp_categories', since edges can carry other metadata, like
+        a '$type', without having been followed. anything else is left to get_batch
+        '''
+        for entry in entities:
+            for edge in edges:
+                for nlp_entry in entry.get(edge, [])[:1]:
+                    if '$id' in nlp_entry and ('$' in nlp_entry or 'nlp_categories' in nlp_entry):
+                        self.followed[nlp_entry['$id']] = dict(nlp_entry, **{'$': {'id': nlp_entry['$id']}})
+
+    def kept(self):
+        '''iterate over the records that haven't been filtered out'''
+        return (record for record, keep in zip(self.records, self.keep) if keep)
+
+    def count(self):
+        return sum(self.keep)
+
+    def filter_by(self, predicate):
+        '''drop any kept records that predicate returns False for'''
+        for i in range(len(self.records)):
+            if self.keep[i] and not predicate(self.records[i]):
+                self.keep[i] = 0
 
     def _extract_nlp_categories(self, nlp_records, nlp_data, type):
         '''any nlp results that do not contain the field 'nlp_categories' are dropped'''
         for i in range(len(nlp_data)):
             nlp_id = nlp_data[i]['$']['id']
             if 'nlp_categories' in nlp_data[i].keys():
-                if type is 'google':
+                if type == 'google':
                     nlp_records[nlp_id].categories['name'] = nlp_data[i]['nlp_categories'][0]['name']
                     nlp_records[nlp_id].categories['confidence'] = nlp_data[i]['nlp_categories'][0]['confidence']
                 else:
@@ -103,25 +180,39 @@ class QueryData:
 
     def _update_records_with_nlp_data(self, nlp_records, type):
         '''update self.records with the extracted nlp data'''
-        cat_key = 'gnlp_categories' if type is 'google' else 'wnlp_categories'
+        cat_key = 'gnlp_categories' if type == 'google' else 'wnlp_categories'
         for key in nlp_records.keys():
-            caas_id = nlp_records[key].caas_id
-            self.records[caas_id][cat_key] = nlp_records[key].categories
+            setattr(nlp_records[key].record, cat_key, nlp_records[key].categories)
 
     def filter_out_empties(self):
         logger.info("filtering out records that don't have urls")
-        self.records = {key: value for key, value in self.records.items() if value['url']}
+        self.filter_by(lambda record: record.url)
 
     def filter_out_training_urls(self, dupes):
         logger.info('filtering out duplicate urls that already exist in the training set')
-        self.records = {key: value for key, value in self.records.items() if value['url'] not in dupes}
+        self.filter_by(lambda record: record.url not in dupes)
+
+    def _init_nlp_records(self, type):
+        '''
+        construct a dict formatted as nlp_id: nlp(record, {}), where the value of
+        nlp_id is a namedtuple called nlp that has 2 fields: record and categories.
+        type should be either 'google' or 'watson'.
+        '''
+        Nlp = namedtuple('Nlp', ['record', 'categories'])
+        id_key = 'gnlp_id' if type == 'google' else 'wnlp_id'
+
+        return {getattr(record, id_key): Nlp(record, {}) for record in self.kept() if getattr(record, id_key)}
+
+    def _chunk_nlp_ids(self, nlp_ids):
+        return [nlp_ids[i:i + self.nlp_batch_size] for i in range(0, len(nlp_ids), self.nlp_batch_size)]
 
-    def get_nlp_data(self, client, type='google'):
+    async def get_nlp_data(self, client):
         '''
-        construct a dict formatted as nlp_id: nlp(caas_id, {}), where the value of
-        nlp_id is a namedtuple called nlp that has 2 fields: caas_id and categories.
-        then query CaaS for google or watson NLP data for the entries in records arg
-        that have associated nlp ids. type kwarg should be either 'google' or 'watson'.
+        query CaaS for the google and watson NLP data of the kept records that have
+        associated nlp ids. nlp records that the search already followed are taken from
+        self.followed, and the ids of both types that are left are merged and split into
+        batches of at most nlp_batch_size, the batches are sent concurrently, and each
+        result is routed back to its record by its '$' id.
 
         currently this function is capturing 'nlp_categories' and their corresponding
         'confidence' level (google) or score (watson).
@@ -130,21 +221,26 @@ class QueryData:
         other available fields for watson are 'nlp_keywords', 'nlp_concepts',
         'nlp_doc_sentiment', and 'nlp_entities'.
         '''
-        logger.info('getting available {} nlp data for this batch of query data'.format(type))
-        Nlp = namedtuple('Nlp', ['caas_id', 'categories'])
-        id_key = 'gnlp_id' if type is 'google' else 'wnlp_id'
-
-        nlp_records = {self.records[key][id_key]: Nlp(key, {}) for key in self.records.keys() if self.records[key][id_key]}
-        nlp_ids = [key for key in nlp_records.keys()]
-        nlp_data = client.get_batch(ids=nlp_ids)
-        logger.info('query returned {} results'.format(len(nlp_data)))
-
-        nlp_records = self._extract_nlp_categories(nlp_records, nlp_data, type)
-        self._update_records_with_nlp_data(nlp_records, type)
+        logger.info('getting available nlp data for this batch of query data')
+        nlp_records = {type: self._init_nlp_records(type) for type in self.nlp_types}
+        nlp_ids = [nlp_id for type in self.nlp_types for nlp_id in nlp_records[type].keys()]
+        nlp_data = {nlp_id: self.followed[nlp_id] for nlp_id in nlp_ids if nlp_id in self.followed}
+        self.followed = {}
+        batches = self._chunk_nlp_ids([nlp_id for nlp_id in nlp_ids if nlp_id not in nlp_data])
+        logger.info('{} nlp records were followed in the search'.format(len(nlp_data)))
+
+        results = await asyncio.gather(*[client.get_batch(ids=batch) for batch in batches])
+        nlp_data.update((entry['$']['id'], entry) for result in results for entry in result)
+        logger.info('{} queries returned {} results'.format(len(batches), len(nlp_data)))
+
+        for type in self.nlp_types:
+            type_data = [nlp_data[nlp_id] for nlp_id in nlp_records[type].keys() if nlp_id in nlp_data]
+            type_records = self._extract_nlp_categories(nlp_records[type], type_data, type)
+            self._update_records_with_nlp_data(type_records, type)
 
     def get_last_sort_id_array(self):
         '''return the last sort id array from the response'''
-        return self.hits[-1]['sort']
+        return self.records[-1].sort_id
 
 
 def _initialize_logger(name):
@@ -155,12 +251,10 @@ def _initialize_logger(name):
 
 def _init_output_file(output_file):
     '''
-    create a new csv file and write headers to it. headers are taken from the
+    create a new output file and write headers to it. headers are taken from the
     QueryData "fieldnames" class variable
     '''
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=QueryData.fieldnames)
-        writer.writeheader()
+    sinks.get_sink(output_file).init_file(output_file, QueryData.fieldnames)
 
     logger.info('{} file initialized with headers'.format(output_file))
     return output_file
@@ -176,6 +270,8 @@ def _check_output(output_file):
         mode = input('o/a: ').lower()
         if mode.lower().startswith('o'):
             return _init_output_file(output_file)
+        elif sinks.get_sink(output_file) is sinks.ParquetSink:
+            raise SystemExit("parquet files can't be appended to")
         else:
             return output_file
 
@@ -198,94 +294,388 @@ def capture_args():
     '''
     capture any arguments supplied to the script on the command line. if an output file
     is specified, check if it already exists and confirm overwrite/append if it does.
-    return None if no output is specified, so we know not to write results.
+    args.output is None if no output is specified, so we know not to write results.
+
+    when resuming, the output file is picked up where its checkpoint left off instead.
     '''
-    if len(sys.argv) > 2:
-        logger.error('too many arguments')
-        logger.info('usage: python3 query.py output_file.csv')
-        raise SystemExit('output_file.csv is optional')
-    elif len(sys.argv) == 2:
-        output = sys.argv[1]
-        output = os.path.join('output', output)
-        return _check_output(output)
+    parser = argparse.ArgumentParser(description='query the CaaS datastore and optionally save the results to a csv file')
+    parser.add_argument('output', nargs='?',
+                        help='csv or parquet file in the output directory to write results to, going by its extension')
+    parser.add_argument('--resume', action='store_true', help="continue an interrupted run from its output file's checkpoint")
+    parser.add_argument('--slices', type=int, default=1,
+                        help='split the query into this many $date windows and search them concurrently')
+    parser.add_argument('--dedupe', choices=DedupeStore.spills, default='disk',
+                        help='where seen caas ids go once there are too many to keep in memory')
+    parser.add_argument('--false-positive-rate', type=float, default=DedupeStore.false_positive_rate,
+                        help='chance of dropping a new entity as a dupe with --dedupe bloom')
+    parser.add_argument('--metrics', help='file to save request and stage timings to when the run ends, '
+                                          'in the prometheus text format if it ends with .prom, otherwise as json')
+    parser.add_argument('--trace', help='file to save a json line for every request and stage to')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export what has a $date at or after the last incremental run of this query, '
+                             'and merge it into the output file by caas id')
+    parser.add_argument('--follow-nlp', action='store_true',
+                        help='have CaaS follow the nlp edges inside each search, instead of fetching them with get_batch')
+    args = parser.parse_args()
+
+    if not args.output:
+        if args.resume:
+            parser.error('--resume needs the output file of the run to resume')
+        if args.incremental:
+            parser.error('--incremental needs the output file to merge new results into')
+        return args
+
+    args.output = os.path.join('output', args.output)
+    if args.incremental:
+        # the output file is updated in place, so there's nothing to confirm
+        if args.resume:
+            parser.error("incremental runs can't be resumed, run again to pick up from the last watermark")
+        if sinks.get_sink(args.output) is not sinks.CsvSink:
+            parser.error('only csv output can be updated incrementally')
+    elif args.resume:
+        if not os.path.isfile(args.output):
+            parser.error('{} does not exist, there is nothing to resume'.format(args.output))
+        if sinks.get_sink(args.output) is not sinks.CsvSink:
+            parser.error('only csv output can be resumed')
     else:
-        return None
+        args.output = _check_output(args.output)
 
+    return args
 
-def drop_dupes(caas_id_set, data):
-    for key in data.records.keys():
-        caas_id = data.records[key]['caas_id']
-        if caas_id in caas_id_set:
-            del data.records[caas_id]
-        else:
-            caas_id_set.add(caas_id)
 
+def drop_dupes(dedupe, data):
+    '''drop records whose caas id was already seen, remembering the rest in dedupe'''
+    data.filter_by(lambda record: dedupe.add(record.caas_id))
+    dedupe.flush()
 
-def write_to_file(outfile, records):
-    '''append records to csv file'''
-    logger.info('writing {} records to {}'.format(len(records), outfile))
 
-    with open(outfile, 'a', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=QueryData.fieldnames)
-        for key in records.keys():
-            writer.writerow(records[key])
+def get_existing_urls():
+    '''
+    return an index of the urls in an existing copy of the training corpus, so
+    we can drop duplicates. the csv has no header row, its columns are:
+    content_source, caas_id, cms_id, content_url, content_type, content_title
 
+    the index is built the first time, and rebuilt whenever the csv is newer than it.
+    urls are canonicalised, so http/https, www. and trailing slashes don't matter
+    '''
+    index = url_index.load_index(training_corpus_path, training_index_path, column=3)
+    logger.info('loaded {} training corpus urls from {}'.format(len(index), training_index_path))
 
-def get_existing_urls():
-    '''this is a one time function to get duplicates from an existing file'''
-    import pandas
+    return index
 
-    csv_file = 'utils/Hair_Classification_Training_Corpus_Content_as_of_06262018.csv'
-    colnames = ['content_source', 'caas_id', 'cms_id', 'content_url', 'content_type', 'content_title']
-    existing = pandas.read_csv(csv_file, names=colnames)
 
-    return existing.content_url.tolist()
+async def produce_pages(caas_client, slice, queue):
+    '''
+    producer half of the query pipeline. searches one slice of the query and puts
+    each page of (entities, hits) on the queue as tuple formatted (slice, page), then
+    searches after that page's last sort id array for the next one while the consumer
+    works on what's already queued. the queue is bounded, so once it's full the
+    producer waits instead of pulling the whole query into memory.
+
+    a page of None tells the consumer the slice is exhausted. if the search fails,
+    the exception is put on the queue in place of a page before it's raised.
+    '''
+    elastic_request = dict(slice['elastic_request'])
+    if slice['search_after']:
+        elastic_request['search_after'] = slice['search_after']
 
+    try:
+        page = await caas_client.search(elastic_request=elastic_request)
+        while page and page[0]:
+            await queue.put((slice, page))
+            page = await caas_client.get_next_results(page[1][-1]['sort'], elastic_request=elastic_request)
+    except Exception as e:
+        await queue.put((slice, e))
+        raise
 
-if __name__ == '__main__':
-    # initialize our logger and check to see if an output file was passed in on the command line
-    logger = configure_logger()
-    output = capture_args()
+    await queue.put((slice, None))
 
-    # get existing urls from a copy of Hair Training Classification Corpus spreadsheet
-    training_urls = get_existing_urls()
 
-    # initialize our caas_client, which is a wrapper Brandon wrote around Time Inc's
-    # caas-python-3-client that makes it a little easier for us to query the CaaS datastore.
-    # this wrapper lives in the utils/client_wrapper.py module
-    caas_client = client_wrapper.CaaSClient(elastic_path=elastic_path,
-                                            query_config_path=query_config_path,
-                                            logger=_initialize_logger('caas_client'))
-
-    # conduct an initial search to see how many results are returned
-    # from the query specified in elastic_search_request.json
-    entities, hits = caas_client.search()
-
-    # we don't need to move past the initial search if we're not outputting to a file
-    if output:
-        caas_ids = set()
-        # caas_client.search() returns a fixed # of results specified in the
-        # elasticsearch request's "size" param. if we are outputting to a file,
-        # we need to extract the data from the current response, write it to our file,
-        # then repeat with the next batch til we're done.
-        while entities:
-            data = QueryData(entities, hits)
-            drop_dupes(caas_ids, data)
-
-            # query CaaS for nlp data if it's available (technically this follows $nlp_id edges)
-            for type in ['google', 'watson']:
-                data.get_nlp_data(caas_client, type=type)
-
-            # drop any records that don't have a url, or that already exist in the training set spreadsheet
+async def consume_pages(caas_client, queue, sink, training_urls, checkpoint, slices, dedupe):
+    '''
+    consumer half of the query pipeline: enrich, filter, and write each page,
+    then checkpoint the run so it can be resumed after the page just written.
+    returns once every slice is exhausted, or as soon as one of them fails.
+
+    each stage is timed in the client's metrics as query_stage_seconds. a lot of
+    time in the "wait" stage means the consumer is waiting on CaaS for pages.
+    '''
+    remaining = len([slice for slice in slices if not slice['done']])
+    metrics = caas_client.metrics
+
+    while remaining:
+        with metrics.timer('query_stage_seconds', stage='wait'):
+            slice, page = await queue.get()
+        if isinstance(page, Exception):
+            break
+        if page is None:
+            slice['done'] = True
+            remaining -= 1
+            checkpoint.save(slices, sink.tell(), [])
+            continue
+
+        with metrics.timer('query_stage_seconds', stage='dedupe'):
+            data = QueryData(*page, follow=caas_client.follow)
+            # the raw entities aren't needed past this point
+            del page
+            drop_dupes(dedupe, data)
+            new_ids = [record.caas_id for record in data.kept()]
+
+        # query CaaS for nlp data if it's available (technically this follows $nlp_id edges).
+        # with --follow-nlp the search has followed them already, so this is only a fallback
+        with metrics.timer('query_stage_seconds', stage='nlp'):
+            await data.get_nlp_data(caas_client)
+
+        # drop any records that don't have a url, or that already exist in the training set spreadsheet
+        with metrics.timer('query_stage_seconds', stage='filter'):
             data.filter_out_empties()
             data.filter_out_training_urls(training_urls)
 
-            # attempt to append this batch to our file. skip this batch
-            # if we get a unicode error which happens occasionally on windows
+        # attempt to append this batch to our file. skip this batch
+        # if we get a unicode error which happens occasionally on windows
+        logger.info('writing {} records to {}'.format(data.count(), sink.path))
+        with metrics.timer('query_stage_seconds', stage='write'):
             try:
-                write_to_file(output, data.records)
+                sink.write(data.kept())
+                metrics.increment('query_records_written_total', data.count())
             except UnicodeEncodeError as e:
                 logger.warning('UnicodeEncodeError encountered when trying to write to file, skipping this batch...')
 
-            logger.info(' - - - - - - - - - - - - - - - - - - - ')
-            entities, hits = caas_client.get_next_results(data.get_last_sort_id_array())
+        with metrics.timer('query_stage_seconds', stage='checkpoint'):
+            slice['search_after'] = data.get_last_sort_id_array()
+            checkpoint.save(slices, sink.tell(), new_ids)
+        metrics.increment('query_pages_total')
+        logger.info(' - - - - - - - - - - - - - - - - - - - ')
+
+
+async def run_pipeline(caas_client, sink, training_urls, checkpoint, slices, dedupe):
+    '''
+    caas_client.search() returns a fixed # of results specified in the
+    elasticsearch request's "size" param. fetching the next batch only needs the
+    last sort id array of the current one, so the next page is requested while
+    the current page is enriched and written, instead of after.
+
+    every slice of the query gets its own producer, and they all feed the one
+    consumer, so the slices are searched concurrently but written one page at a
+    time, deduplicated against each other.
+    '''
+    searching = [slice for slice in slices if not slice['done']]
+    queue = asyncio.Queue(maxsize=prefetch_pages * len(searching))
+    producers = [asyncio.ensure_future(produce_pages(caas_client, slice, queue)) for slice in searching]
+
+    try:
+        await consume_pages(caas_client, queue, sink, training_urls, checkpoint, slices, dedupe)
+    finally:
+        # producers only outlive the consumer if something went wrong
+        for producer in producers:
+            producer.cancel()
+        results = await asyncio.gather(*producers, return_exceptions=True)
+
+    # reraise anything that stopped a producer early
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+            raise result
+
+
+def resume_from_checkpoint(checkpoint, output):
+    '''
+    cut the output file back to the size it had when the checkpoint was saved, since
+    anything past that belongs to a page that will be fetched and written again.
+    return tuple formatted (slices, iterator over the caas ids already seen)
+    '''
+    try:
+        saved = checkpoint.load()
+    except ValueError as e:
+        raise SystemExit(e)
+
+    if not saved:
+        raise SystemExit('no checkpoint found for {}, nothing to resume'.format(output))
+
+    with open(output, 'r+b') as outfile:
+        outfile.truncate(saved['offset'])
+
+    logger.info('resuming {} with {} of {} slices left'.format(
+        output, len([slice for slice in saved['slices'] if not slice['done']]), len(saved['slices'])))
+    return saved['slices'], checkpoint.seen_ids()
+
+
+async def init_slices(caas_client, slices, elastic_request):
+    '''split elastic_request into slices, which start from the first page and aren't done'''
+    sliced_requests = await caas_client.slice_elastic_request(elastic_request, slices)
+    return [{'elastic_request': request, 'search_after': None, 'done': False} for request in sliced_requests]
+
+
+async def export_query(caas_client, output, training_urls, resume=False, slices=1, dedupe=None, elastic_request=None):
+    '''
+    run the query into output, leaving caas_client open, so it can be shared with other queries.
+    dedupe is a DedupeStore to drop already seen caas ids with, a default one is used if it's None.
+    elastic_request is run in place of the one in elastic_search_request.json if it's given
+    '''
+    dedupe = dedupe if dedupe is not None else DedupeStore(logger=logger)
+    search_params = caas_client._construct_search_params(elastic_request=elastic_request)
+    # the client's own elastic_request changes with every search it sends
+    elastic_request = search_params['elasticsearchRequest']
+    checkpoint = Checkpoint(output, search_params)
+    if resume:
+        slices, caas_ids = resume_from_checkpoint(checkpoint, output)
+        for caas_id in caas_ids:
+            dedupe.add(caas_id)
+        dedupe.flush()
+    else:
+        checkpoint.clear()
+
+    sink = sinks.get_sink(output)(output, QueryData.fieldnames)
+    try:
+        if not resume:
+            # save a plan before anything is searched, so a run that fails from here on can
+            # always be resumed: the whole query to begin with, then its slices once they're known
+            checkpoint.save(await init_slices(caas_client, 1, elastic_request), sink.tell(), [])
+            slices = await init_slices(caas_client, slices, elastic_request)
+            checkpoint.save(slices, sink.tell(), [])
+        await run_pipeline(caas_client, sink, training_urls, checkpoint, slices, dedupe)
+    finally:
+        sink.close()
+        dedupe.close()
+
+    checkpoint.remove()
+
+
+async def run_query(caas_client, output, training_urls, resume=False, slices=1, dedupe=None, elastic_request=None):
+    '''export_query(), closing caas_client once it's done'''
+    async with caas_client:
+        # we don't need to move past an initial search if we're not outputting to a file.
+        # it'll show how many results are returned from the query specified in
+        # elastic_search_request.json
+        if not output:
+            await caas_client.search(elastic_request=elastic_request)
+            return
+
+        await export_query(caas_client, output, training_urls, resume=resume, slices=slices, dedupe=dedupe,
+                           elastic_request=elastic_request)
+
+
+def upsert_rows(output, delta):
+    '''
+    merge the csv rows of delta into output by caas id: rows output already has are
+    replaced where they are, and new ones are appended. the merge is written to a
+    temporary file that then replaces output, so output is never left half merged.
+    delta is read into memory, it's only what's new since the last run.
+    return tuple formatted (replaced, added)
+    '''
+    caas_id = QueryData.fieldnames.index('caas_id')
+    with open(delta, newline='') as delta_file:
+        reader = csv.reader(delta_file)
+        next(reader, None)
+        rows = {row[caas_id]: row for row in reader}
+
+    replaced = 0
+    merged = output + '.merging'
+    with open(merged, 'w', newline='') as merged_file:
+        writer = csv.writer(merged_file)
+        writer.writerow(QueryData.fieldnames)
+        if os.path.isfile(output):
+            with open(output, newline='') as output_file:
+                reader = csv.reader(output_file)
+                next(reader, None)
+                for row in reader:
+                    if row[caas_id] in rows:
+                        row = rows.pop(row[caas_id])
+                        replaced += 1
+                    writer.writerow(row)
+        writer.writerows(rows.values())
+
+    os.replace(merged, output)
+    return replaced, len(rows)
+
+
+async def export_incremental(caas_client, output, training_urls, slices=1, dedupe=None, elastic_request=None):
+    '''
+    export only the entities with a "$date" at or after the query's watermark into a
+    delta file, then upsert them into output by caas id. the first incremental run of
+    a query has no watermark, so it exports everything.
+
+    the new watermark is the latest "$date" the query matched before searching, and
+    it's saved once the merge is done, so anything that turns up mid-run is picked up
+    by the next one. entities without a "$date" can't be tracked this way, so they're
+    only exported by the first run, or a full run. if output has gone missing, its
+    watermarks are cleared and the whole query is exported again.
+
+    like export_query(), caas_client is left open, and elastic_request is run in
+    place of the one in elastic_search_request.json if it's given
+    '''
+    watermarks = Watermarks(output)
+    if elastic_request is None:
+        elastic_request = caas_client._construct_elastic_request(caas_client.elastic_path)
+    search_params = caas_client._construct_search_params(elastic_request=elastic_request)
+    if not os.path.isfile(output) and watermarks.count():
+        # the rows the watermarks stood for are gone, so merging from them would drop everything older
+        logger.warning("{} doesn't exist, clearing its watermarks and exporting the whole query".format(output))
+        watermarks.clear()
+    since = watermarks.get(search_params)
+    latest = await caas_client.latest_date(elastic_request)
+
+    if since is not None:
+        logger.info('exporting entities with a $date of {} or later'.format(since))
+        elastic_request = caas_client._construct_since_request(elastic_request, since)
+    else:
+        logger.info('no watermark for this query yet, exporting all of it')
+
+    delta = _init_output_file(output + delta_suffix)
+    await export_query(caas_client, delta, training_urls, slices=slices, dedupe=dedupe, elastic_request=elastic_request)
+
+    replaced, added = upsert_rows(output, delta)
+    os.remove(delta)
+    logger.info('merged into {}: {} rows replaced, {} added'.format(output, replaced, added))
+
+    if latest is not None:
+        watermarks.set(search_params, latest)
+    watermarks.close()
+
+
+async def run_incremental(caas_client, output, training_urls, slices=1, dedupe=None):
+    '''export_incremental(), closing caas_client once it's done'''
+    async with caas_client:
+        await export_incremental(caas_client, output, training_urls, slices=slices, dedupe=dedupe)
+
+
+if __name__ == '__main__':
+    # initialize our logger and check to see if an output file was passed in on the command line
+    logger = configure_logger()
+    args = capture_args()
+
+    # get existing urls from a copy of Hair Training Classification Corpus spreadsheet
+    training_urls = get_existing_urls()
+
+    # initialize our caas_client, which is a wrapper Brandon wrote around Time Inc's
+    # caas-python-3-client that makes it a little easier for us to query the CaaS datastore.
+    # this wrapper lives in the utils/client_wrapper.py module. the async variant lets
+    # us fetch the next page of results while the current one is being processed.
+    # entities and nlp records fetched by earlier runs are served from a local cache
+    cache = entity_cache.EntityCache(path=cache_path)
+    metrics = Metrics(trace=bool(args.trace))
+    caas_client = client_wrapper.AsyncCaaSClient(elastic_path=elastic_path,
+                                                 query_config_path=query_config_path,
+                                                 logger=_initialize_logger('caas_client'),
+                                                 cache=cache, metrics=metrics, entity_fields=QueryData.entity_fields,
+                                                 follow=list(QueryData.nlp_edges.values()) if args.follow_nlp else None)
+
+    dedupe = DedupeStore(spill=args.dedupe, false_positive_rate=args.false_positive_rate, logger=logger)
+
+    try:
+        if args.incremental:
+            asyncio.run(run_incremental(caas_client, args.output, training_urls, slices=args.slices, dedupe=dedupe))
+        else:
+            asyncio.run(run_query(caas_client, args.output, training_urls, resume=args.resume, slices=args.slices,
+                                  dedupe=dedupe))
+    finally:
+        # save the timings even if the run failed, they might say why
+        if args.metrics:
+            metrics.write(args.metrics)
+            logger.info('saved metrics to {}'.format(args.metrics))
+        if args.trace:
+            metrics.write_trace(args.trace)
+            logger.info('saved {} trace spans to {}'.format(len(metrics.spans), args.trace))
+
+    logger.info('entity cache hits: {hits}, misses: {misses}'.format(**cache.stats()))
+    cache.close()
+    training_urls.close()
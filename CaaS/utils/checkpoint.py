@@ -0,0 +1,76 @@
+# checkpoints for resuming interrupted caas_query.py runs
+# 10/18/26
+# updated 10/18/26
+
+import os
+import json
+import sqlite3
+
+
+class Checkpoint:
+    '''
+    sqlite file kept next to an output file that records how far a query got.
+    after each page is written, save() stores the state of every slice of the query
+    (its elastic request, the last sort id array written, and whether it's exhausted),
+    the size of the output file, and the caas ids that were added to the dedupe set,
+    all in a single transaction, so a crash leaves either the old checkpoint or the
+    new one and never half of each.
+
+    the search params of the query are saved along with it, so a checkpoint can't
+    be used to resume a different query by mistake.
+    '''
+
+    suffix = '.checkpoint'
+
+    def __init__(self, output_file, search_params):
+        self.path = output_file + self.suffix
+        self.query = self.fingerprint(search_params)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seen (caas_id TEXT PRIMARY KEY)')
+        self.conn.commit()
+
+    @staticmethod
+    def fingerprint(search_params):
+        '''identify a query by its search params, ignoring where it's currently paged to'''
+        elastic_request = {key: value for key, value in search_params['elasticsearchRequest'].items() if key != 'search_after'}
+        params = dict(search_params, elasticsearchRequest=elastic_request)
+
+        return json.dumps(params, sort_keys=True)
+
+    def _get(self, key):
+        row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load(self):
+        '''
+        return a dict with the saved slices and offset, or None if nothing was saved yet.
+        raise ValueError if the checkpoint was saved by a different query
+        '''
+        query = self._get('query')
+        if query is None:
+            return None
+        if query != self.query:
+            raise ValueError('{} was saved by a different query'.format(self.path))
+
+        return {'slices': self._get('slices'), 'offset': self._get('offset')}
+
+    def seen_ids(self):
+        return (row[0] for row in self.conn.execute('SELECT caas_id FROM seen'))
+
+    def save(self, slices, offset, caas_ids):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                                  [(key, json.dumps(value)) for key, value in
+                                   [('query', self.query), ('slices', slices), ('offset', offset)]])
+            self.conn.executemany('INSERT OR IGNORE INTO seen (caas_id) VALUES (?)', [(id,) for id in caas_ids])
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM state')
+            self.conn.execute('DELETE FROM seen')
+
+    def remove(self):
+        '''delete the checkpoint file once its run has finished'''
+        self.conn.close()
+        os.remove(self.path)
@@ -1,31 +1,53 @@
 # wrapper for legacy Time Inc's python 3 CaaS client hosted here:
 # https://github.com/TimeInc/caas-content-client-python-3
 # 5/21/18
-# updated 6/27/18
+# updated 10/18/26
 
 import os
 import sys
 import yaml
 import json
+import random
+import asyncio
+import inspect
 import logging
 import logging.config
-from time import sleep
+import requests
+from time import time, sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
 
 # try importing the caas_keys module
-# the import statement varies depending on where this client_wrapper module is imported
+# the import statement varies depending on where this client_wrapper module is imported.
+# it's only needed to talk to the real CaaS, so running against utils/mock_caas.py works without it
 try:
     from . import caas_keys
 except ImportError:
-    import caas_keys
+    try:
+        import caas_keys
+    except ImportError:
+        caas_keys = None
+
+try:
+    from .rate_limiter import AdaptiveRateLimiter
+    from .metrics import Metrics
+    from . import json_stream
+except ImportError:
+    from rate_limiter import AdaptiveRateLimiter
+    from metrics import Metrics
+    import json_stream
 
 
 def get_basepath():
     return os.path.dirname(os.path.realpath(__file__))
 
 
-# add the caas python 3 client to our path so the script can use it
+# add the caas python 3 client to our path so the script can use it.
+# like caas_keys, it isn't needed when an entity_client is passed in
 sys.path.insert(0, os.path.join(get_basepath(), 'caas-content-client-python-3'))
-from caas_content_client_python_3 import client
+try:
+    from caas_content_client_python_3 import client
+except ImportError:
+    client = None
 
 
 class CaaSClient:
@@ -36,9 +58,62 @@ class CaaSClient:
     in when constructing a CaaSClient instance unless you're using it from its directory.
 
     check the docstrings for construct_search_params() and search() methods for more info
+
+    if an EntityCache from utils/entity_cache.py is passed in as cache, the entities
+    returned by search() are stored in it, and get_batch() only asks CaaS for the ids
+    it doesn't already hold.
+
+    every request waits on an AdaptiveRateLimiter from utils/rate_limiter.py first,
+    and throttled or failed requests are retried with backoff. see _send() for details.
+
+    requests are sent through Time's EntityServiceClient unless entity_client is
+    passed in, which can be anything with the same search() and get_batch() methods,
+    like the MockEntityClient in utils/mock_caas.py.
+
+    every request is recorded in self.metrics, a Metrics from utils/metrics.py that
+    can be passed in to share it with the caller: the latency, response size, retries
+    and rate limiter wait of each call to search and get_batch, and the entities per page.
+
+    search responses are decoded with utils/json_stream.py, using json_backend. if the
+    entity client's search() takes a stream keyword, like MockEntityClient's, searches
+    are sent with stream=True and decoded straight off the connection, so with ijson a
+    page is never held as a whole body. clients without one hand back
+    the body already read, which is decoded from memory instead.
+
+    entity_fields is the list of entity fields the caller reads, e.g.
+    QueryData.entity_fields, and extra_fields opts in to any others. when it's given,
+    searches only ask CaaS for those fields plus required_fields (see _project()),
+    and every entity search() returns is cut down to them as it's decoded, so the
+    article body and other big fields are neither sent nor held for a whole page.
+    cut down entities aren't put in the cache, since get_batch() returns it as if
+    it were complete.
+
+    follow is a list of edges, like "$i_nlp_source_google", for CaaS to follow inside
+    every search, on top of any in query_config.json. the entities they point to come
+    back embedded in the edges of each entity, instead of needing a get_batch() of their own.
     '''
 
     log_file = 'caas_client.log'
+
+    # retry throttled (429) and failed (5xx) requests this many times, backing off
+    # for a random time up to max_backoff seconds, or base_backoff * 2^retry if that's less
+    retry_status_codes = [429, 500, 502, 503, 504]
+    max_retries = 5
+    base_backoff = 0.5
+    max_backoff = 30
+
+    # resolve_urls() packs this many urls into each "terms" query, and pages
+    # through the results this many entities at a time
+    url_batch_size = 200
+    url_page_size = 100
+
+    # 'auto' picks ijson, then orjson, then json, whichever is installed first
+    json_backend = 'auto'
+
+    # fields the client reads from search results itself: ids, "$date" to slice
+    # queries with, and "web_article_url" to match entities in resolve_urls()
+    required_fields = ['$', '$date', 'web_article_url']
+
     elastic_path = '../config/elastic_search_request.json'
     query_config_path = '../config/query_config.json'
 
@@ -49,13 +124,20 @@ class CaaSClient:
         "sort": [{"$date": {"unmapped_type": "long", "order": "desc"}}]
     }
 
-    def __init__(self, elastic_path=elastic_path, query_config_path=query_config_path, logger=None):
+    def __init__(self, elastic_path=elastic_path, query_config_path=query_config_path, logger=None, cache=None,
+                 rate_limiter=None, entity_client=None, metrics=None, entity_fields=None, extra_fields=None, follow=None):
         self.logger = logger if logger else self._init_logger()
-        self.client = self._init_client()
+        self.entity_fields = self._init_entity_fields(entity_fields, extra_fields)
+        self.follow = list(follow or [])
+        self.metrics = metrics if metrics else Metrics()
+        self.rate_limiter = rate_limiter if rate_limiter else AdaptiveRateLimiter(logger=self.logger)
+        self.client = entity_client if entity_client else self._init_client()
+        self.stream_search = self._takes_stream(self.client.search)
         self.elastic_path = elastic_path
         self.elastic_request = None
         self.query_config_path = query_config_path
         self.num_query_results = 0
+        self.cache = cache
 
     def _init_logger(self):
         with open('log.yaml', 'r') as log_conf:
@@ -68,8 +150,28 @@ class CaaSClient:
 
         return logging.getLogger('caas_client')
 
+    def _init_entity_fields(self, entity_fields, extra_fields):
+        '''the fields to project searches to, without repeats, or None to get whole entities'''
+        if entity_fields is None:
+            return None
+
+        return list(dict.fromkeys(self.required_fields + list(entity_fields) + list(extra_fields or [])))
+
+    def _takes_stream(self, send):
+        '''whether send takes a stream keyword argument'''
+        try:
+            parameters = inspect.signature(send).parameters.values()
+        except (TypeError, ValueError):
+            return False
+
+        return any(parameter.name == 'stream' or parameter.kind == parameter.VAR_KEYWORD for parameter in parameters)
+
     def _init_client(self, env='prod'):
         """env can be either 'test' or 'prod', but we'll only ever use 'prod'"""
+        if client is None or caas_keys is None:
+            raise ImportError('the caas python 3 client and a caas_keys module are needed to query CaaS, '
+                              'see the README, or pass in an entity_client')
+
         caas_client = client.EntityServiceClient(env)
         caas_client.x_api_key = caas_keys.CAAS_API_PROD_KEY  # specify our API key for the client
 
@@ -117,6 +219,26 @@ class CaaSClient:
         self.elastic_request = elastic_request if elastic_request else self._construct_elastic_request(self.elastic_path)
         search_params = {key: value for key, value in query_config.items()}
         search_params['elasticsearchRequest'] = self.elastic_request
+        if self.follow:
+            search_params['follow'] = list(dict.fromkeys(list(search_params.get('follow') or []) + self.follow))
+
+        return self._project(search_params)
+
+    def _project(self, search_params):
+        '''
+        if we have entity_fields, ask CaaS for just those: as the "fields" search param,
+        unless query_config.json sets one, and as the "_source" includes of the elastic
+        request, unless it already has a "_source". the elastic request is copied rather
+        than changed, since it's the search_after cursor get_next_results() moves along
+        '''
+        if not self.entity_fields:
+            return search_params
+
+        if not search_params.get('fields'):
+            search_params['fields'] = ','.join(self.entity_fields)
+        if '_source' not in search_params['elasticsearchRequest']:
+            search_params['elasticsearchRequest'] = dict(search_params['elasticsearchRequest'],
+                                                         _source={'includes': self.entity_fields})
 
         return search_params
 
@@ -127,40 +249,144 @@ class CaaSClient:
         '''
         self.num_query_results = int(query_data['found'])
         self.logger.info('query returned {} results'.format(self.num_query_results))
+        self.metrics.observe('caas_entities_per_page', len(query_data.get('entities', [])))
 
-        return (query_data['entities'], query_data['hits']['hits']) if self.num_query_results else None
+        if not self.num_query_results:
+            return None
 
-    def search(self, elastic_request=None):
+        entities = query_data['entities'] if self.entity_fields else self._cache_entities(query_data['entities'])
+        return entities, query_data['hits']['hits']
+
+    def _check_cache(self, ids):
+        '''split ids into a tuple formatted (cached entities, ids that still need to be fetched)'''
+        if not self.cache:
+            return [], ids
+
+        cached = self.cache.get_many(ids)
+        return list(cached.values()), [id for id in ids if id not in cached]
+
+    def _cache_entities(self, entities):
+        if self.cache and entities:
+            self.cache.put_many(entities)
+
+        return entities
+
+    def _handle_response(self, response, decode=None):
         '''
-        if a specific elastic request is passed in here, it will be forwarded to
-        construct_search_params. otherwise construct_search_params uses
-        elastic_search_request.json to construct the parameters
+        return the decoded json body of a successful response, decoded with
+        decode(response) if it's given, otherwise log the status code and raise the error
         '''
-        tries = 5
-        success = False
-        self.logger.info('querying CaaS via client.search()...')
+        if response.status_code == 200:
+            return decode(response) if decode else response.json()
+        else:
+            self.logger.error('query failed with response code {}'.format(response.status_code))
+            self.logger.error('raising the error so we can look at it')
+            # a streamed response holds on to its connection until it's closed
+            response.close()
+            response.raise_for_status()
+
+    def _backoff(self, retry):
+        '''full jitter: sleep a random time up to the exponential backoff for this retry'''
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** retry))
+        self.logger.warning('retrying in {:.2f} seconds...'.format(delay))
+        sleep(delay)
+
+    def _response_size(self, response):
+        '''
+        the size of the response body on the wire, going by its Content-Length header,
+        or None if it doesn't have one. reading .content to measure it would pull the
+        whole body into memory before it could be decoded as a stream
+        '''
+        length = response.headers.get('Content-Length')
+        return int(length) if length and length.isdigit() else None
+
+    def _send(self, send, params, **kwargs):
+        '''
+        wait for the rate limiter, then call send (one of Time's client methods) with params
+        and any kwargs.
+        malformed responses, connection errors and responses with a status code in
+        retry_status_codes are retried up to max_retries times with jittered exponential
+        backoff, and tell the rate limiter to slow down. successful responses tell it how
+        long they took. once the retries run out, the last response is returned so the
+        caller can raise its status, or the last exception is reraised.
+        '''
+        operation = send.__name__
+        for retry in range(self.max_retries + 1):
+            self.metrics.observe('caas_rate_limit_wait_seconds', self.rate_limiter.acquire(), operation=operation)
+            started = time()
+            start = monotonic()
 
-        while not success and tries:
             try:
-                search_params = self._construct_search_params(elastic_request=elastic_request)
-                response = self.client.search(search_params)
-                success = True
+                response = send(params, **kwargs)
             except KeyError:
-                tries -= 1
                 self.logger.warning("query response doesn't have the expected keys")
-                self.logger.warning('retrying search...')
+                if retry == self.max_retries:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.logger.warning('request failed: {}'.format(e))
+                if retry == self.max_retries:
+                    raise
             except Exception:
                 self.logger.error('something went wrong...')
                 self.logger.error('reraising the exception so we can look at the stack trace')
-                sleep(1)
                 raise
+            else:
+                latency = monotonic() - start
+                size = self._response_size(response)
+                self.metrics.observe('caas_request_seconds', latency, operation=operation)
+                if size is not None:
+                    self.metrics.observe('caas_response_bytes', size, operation=operation)
+                self.metrics.increment('caas_responses_total', operation=operation, status=response.status_code)
+                self.metrics.add_span('caas_' + operation, started, latency, status=response.status_code,
+                                      retry=retry, bytes=size)
+
+                if response.status_code not in self.retry_status_codes:
+                    self.rate_limiter.on_success(latency)
+                    return response
+
+                self.logger.warning('query returned response code {}'.format(response.status_code))
+                if retry == self.max_retries:
+                    return response
+                response.close()
+
+            self.metrics.increment('caas_retries_total', operation=operation)
+            self.rate_limiter.on_throttle()
+            self._backoff(retry)
+
+    def _send_search(self, search_params):
+        if self.stream_search:
+            return self._send(self.client.search, search_params, stream=True)
+
+        return self._send(self.client.search, search_params)
+
+    def _decode_search(self, response):
+        '''
+        decode a search response, straight off the connection if it was streamed.
+        caas_search_decodes_total counts how many were, by their "streamed" label.
+        if decoding fails partway, the response is closed so its connection isn't reused
+        '''
+        self.metrics.increment('caas_search_decodes_total', streamed=str(json_stream.is_streamed(response)).lower())
+        try:
+            return json_stream.decode_search_response(response, backend=self.json_backend, fields=self.entity_fields)
+        except Exception:
+            response.close()
+            raise
 
-        if response.status_code == 200:
-            return self._parse_search_response(response.json())
-        else:
-            self.logger.error('query failed with response code {}'.format(response.status_code))
-            self.logger.error('raising the error so we can look at it')
-            response.raise_for_status()
+    def _fetch_search(self, search_params):
+        '''send a search and return its decoded body, in one call so AsyncCaaSClient can run both in its pool'''
+        return self._handle_response(self._send_search(search_params), decode=self._decode_search)
+
+    def search(self, elastic_request=None):
+        '''
+        if a specific elastic request is passed in here, it will be forwarded to
+        construct_search_params. otherwise construct_search_params uses
+        elastic_search_request.json to construct the parameters
+        '''
+        self.logger.info('querying CaaS via client.search()...')
+        search_params = self._construct_search_params(elastic_request=elastic_request)
+        query_data = self._fetch_search(search_params)
+
+        return self._parse_search_response(query_data) if query_data else None
 
     def get_next_results_using_from(self):
         '''
@@ -178,45 +404,286 @@ class CaaSClient:
             self.logger.info('query results exhausted')
             return None
 
-    def get_next_results(self, last_sort_id_array):
+    def get_next_results(self, last_sort_id_array, elastic_request=None):
         '''
         loop through query data by incrementing the elasticsearch request's
         "search_after" parameter and calling search() for a new batch of results.
 
         last_sort_id_array comes from response['hits'] and should be a list, even if
         it's only a single element.
+
+        the last request searched is paged through unless a specific elastic request
+        is passed in, which lets several cursors (e.g. the slices of a sliced query)
+        be paged through independently.
         '''
-        self.elastic_request["search_after"] = last_sort_id_array
+        elastic_request = elastic_request if elastic_request else self.elastic_request
+        elastic_request["search_after"] = last_sort_id_array
         self.logger.info('getting results for next query batch by searching after sort id array: {}'.format(last_sort_id_array))
-        return self.search(elastic_request=self.elastic_request)
+        return self.search(elastic_request=elastic_request)
+
+    def _construct_date_bounds_request(self, elastic_request, order):
+        '''request for the single entity with the earliest ('asc') or latest ('desc') "$date"'''
+        return dict(elastic_request, size=1, sort=[{"$date": {"unmapped_type": "long", "order": order}}])
+
+    def _parse_date_bound(self, response):
+        '''
+        return the "$date" sort value of the only hit in response, or None if there
+        are no results, or the entity doesn't have a "$date" at all
+        '''
+        if not response or not response[0] or '$date' not in response[0][0]:
+            return None
+
+        return response[1][0]['sort'][0]
+
+    def _construct_sliced_requests(self, elastic_request, earliest, latest, slices):
+        '''
+        split elastic_request into disjoint partitions: slices "$date" windows that
+        together cover earliest to latest, plus one for entities that don't have a
+        "$date", so nothing the original request matches is lost. each partition
+        keeps the "_uid" sort, so it can be paged through with its own search_after cursor.
+        '''
+        query = elastic_request.get('query', {"match_all": {}})
+        width = (latest - earliest) // slices + 1
+        windows = [{"range": {"$date": {"gte": earliest + i * width, "lt": earliest + (i + 1) * width}}}
+                   for i in range(slices)]
+
+        sliced_requests = [dict(elastic_request, query={"bool": {"must": [query], "filter": [window]}}) for window in windows]
+        sliced_requests.append(dict(elastic_request, query={"bool": {"must": [query], "must_not": [{"exists": {"field": "$date"}}]}}))
+
+        return sliced_requests
+
+    def _construct_since_request(self, elastic_request, since):
+        '''
+        elastic_request narrowed to entities whose "$date" is at or after since. it's
+        "gte" rather than "gt", so an entity that turns up later with the same "$date"
+        as the last one exported isn't skipped, at the cost of exporting that one again
+        '''
+        query = elastic_request.get('query', {"match_all": {}})
+        return dict(elastic_request, query={"bool": {"must": [query], "filter": [{"range": {"$date": {"gte": since}}}]}})
 
     def get_batch(self, ids=[]):
         '''
         wraps Time's caas client.get_batch() method.
         currently using this to get nlp results by following "$nlp_id" edges
         '''
+        cached, ids = self._check_cache(ids)
+        if not ids:
+            return cached
+
         self.logger.info('querying CaaS via client.get_batch()...')
+        batch_params = self._construct_batch_params(ids)
+
+        return cached + self._cache_entities(self._handle_response(self._send_batch(batch_params)))
 
-        batch_params = {
+    def _construct_batch_params(self, ids):
+        return {
             "batchRequest": {
                 "Ids": ids
             }
         }
 
-        try:
-            response = self.client.get_batch(batch_params)
-        except Exception:
-            self.logger.error('something went wrong...')
-            self.logger.error('reraising the exception so we can look at the stack trace')
-            sleep(1)
-            raise
+    def _send_batch(self, batch_params):
+        return self._send(self.client.get_batch, batch_params)
 
-        if response.status_code == 200:
-            return response.json()
-        else:
-            self.logger.error('query failed with response code {}'.format(response.status_code))
-            self.logger.error('raising the error so we can look at it')
-            response.raise_for_status()
+    def _url_variants(self, url):
+        '''the http/https and with/without "www." versions of url'''
+        address = url.strip().split('://', 1)[-1]
+        address = address[4:] if address.startswith('www.') else address
+
+        return ['{}://{}{}'.format(scheme, www, address) for scheme in ['http', 'https'] for www in ['www.', '']]
+
+    def _construct_url_requests(self, urls):
+        '''
+        return tuple formatted (variants, url_requests). variants maps every variant of
+        every url to the urls it came from. url_requests holds an elastic request with a
+        "terms" filter on "web_article_url.raw" for each batch of url_batch_size urls
+        '''
+        variants = {}
+        url_requests = []
+
+        for i in range(0, len(urls), self.url_batch_size):
+            batch_variants = []
+            for url in urls[i:i + self.url_batch_size]:
+                for variant in self._url_variants(url):
+                    if variant not in variants:
+                        batch_variants.append(variant)
+                    variants.setdefault(variant, []).append(url)
+
+            url_requests.append({
+                "size": self.url_page_size,
+                "query": {"constant_score": {"filter": {"terms": {"web_article_url.raw": batch_variants}}}},
+                "sort": [{"_uid": "desc"}]
+            })
+
+        self.logger.info('resolving {} urls with {} terms queries'.format(len(urls), len(url_requests)))
+        return variants, url_requests
+
+    def _map_url_entities(self, variants, entities, found):
+        '''add each entity to the found list of every url its "web_article_url" is a variant of'''
+        for entity in entities:
+            for url in variants.get(entity.get('web_article_url'), []):
+                found.setdefault(url, []).append(entity)
+
+    def _is_last_page(self, page, elastic_request):
+        return not page or len(page[0]) < elastic_request['size']
+
+    def resolve_urls(self, urls):
+        '''
+        find the CaaS entities for a list of urls, matching any of their http/https and
+        "www." variants. instead of a search per url, url_batch_size urls go into each
+        "terms" query, which is paged through with search_after.
+
+        returns tuple formatted (found, not_found). found maps each url that matched to
+        a list of its entities, and each entity's "web_article_url" is the variant that
+        matched. not_found lists the urls that didn't match anything.
+        '''
+        variants, url_requests = self._construct_url_requests(urls)
+        found = {}
+
+        for elastic_request in url_requests:
+            page = self.search(elastic_request=elastic_request)
+            while page:
+                self._map_url_entities(variants, page[0], found)
+                page = None if self._is_last_page(page, elastic_request) else \
+                    self.get_next_results(page[1][-1]['sort'], elastic_request=elastic_request)
+
+        return found, [url for url in urls if url not in found]
+
+
+class AsyncCaaSClient(CaaSClient):
+    '''
+    asyncio variant of CaaSClient. search(), get_next_results() and get_batch()
+    take the same arguments and return the same data, but are coroutines.
+
+    Time's python3 client is blocking, so requests are sent from a thread pool
+    that's shared by every call made through this instance. the size of the pool
+    is the concurrency limit: at most max_concurrency requests are in flight at
+    once and anything past that waits its turn. search params are still built on
+    the event loop, so the only work done in the pool is the round trip itself and,
+    for searches, decoding the response, which would otherwise hold up the loop.
+
+    use it as an async context manager, or call close() when finished with it,
+    so the pool's threads get shut down.
+
+    one client can be shared by several queries running at once, see batch_query.py.
+    get_batch() doesn't ask for ids that another call is already fetching, it waits
+    for that call instead, so an nlp record the queries have in common is fetched once.
+    '''
+
+    max_concurrency = 8
+
+    def __init__(self, elastic_path=CaaSClient.elastic_path, query_config_path=CaaSClient.query_config_path,
+                 logger=None, cache=None, rate_limiter=None, max_concurrency=max_concurrency, entity_client=None,
+                 metrics=None, entity_fields=None, extra_fields=None, follow=None):
+        super().__init__(elastic_path=elastic_path, query_config_path=query_config_path, logger=logger, cache=cache,
+                         rate_limiter=rate_limiter, entity_client=entity_client, metrics=metrics,
+                         entity_fields=entity_fields, extra_fields=extra_fields, follow=follow)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # id: future of the get_batch() call fetching it
+        self.in_flight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def _run(self, func, *args):
+        '''run a blocking call in the shared pool and wait for its result'''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def search(self, elastic_request=None):
+        self.logger.info('querying CaaS via client.search()...')
+        search_params = self._construct_search_params(elastic_request=elastic_request)
+        query_data = await self._run(self._fetch_search, search_params)
+
+        return self._parse_search_response(query_data) if query_data else None
+
+    async def get_next_results(self, last_sort_id_array, elastic_request=None):
+        elastic_request = elastic_request if elastic_request else self.elastic_request
+        elastic_request["search_after"] = last_sort_id_array
+        self.logger.info('getting results for next query batch by searching after sort id array: {}'.format(last_sort_id_array))
+        return await self.search(elastic_request=elastic_request)
+
+    async def slice_elastic_request(self, elastic_request, slices):
+        '''
+        split elastic_request into disjoint partitions that can be searched concurrently,
+        each with its own search_after cursor. the partitions are "$date" windows, so
+        the earliest and latest "$date" the request matches are looked up first.
+        returns a list holding just elastic_request if it can't be split.
+        '''
+        if slices < 2:
+            return [elastic_request]
+
+        earliest, latest = await asyncio.gather(
+            *[self.search(elastic_request=self._construct_date_bounds_request(elastic_request, order))
+              for order in ['asc', 'desc']])
+        earliest, latest = self._parse_date_bound(earliest), self._parse_date_bound(latest)
+
+        if earliest is None or latest is None:
+            self.logger.warning("couldn't find a $date range to slice the query by, searching it as a whole")
+            return [elastic_request]
+
+        self.logger.info('slicing query into {} $date windows between {} and {}'.format(slices, earliest, latest))
+        return self._construct_sliced_requests(elastic_request, earliest, latest, slices)
+
+    async def latest_date(self, elastic_request):
+        '''the latest "$date" elastic_request matches, or None if nothing it matches has a "$date"'''
+        return self._parse_date_bound(await self.search(elastic_request=self._construct_date_bounds_request(elastic_request, 'desc')))
+
+    async def _resolve_url_request(self, variants, elastic_request, found):
+        page = await self.search(elastic_request=elastic_request)
+        while page:
+            self._map_url_entities(variants, page[0], found)
+            page = None if self._is_last_page(page, elastic_request) else \
+                await self.get_next_results(page[1][-1]['sort'], elastic_request=elastic_request)
+
+    async def resolve_urls(self, urls):
+        '''same as CaaSClient.resolve_urls(), but the terms queries are searched concurrently'''
+        variants, url_requests = self._construct_url_requests(urls)
+        found = {}
+
+        await asyncio.gather(*[self._resolve_url_request(variants, elastic_request, found)
+                               for elastic_request in url_requests])
+
+        return found, [url for url in urls if url not in found]
+
+    async def get_batch(self, ids=[]):
+        cached, ids = self._check_cache(ids)
+        waiting = {id: self.in_flight[id] for id in ids if id in self.in_flight}
+        ids = [id for id in ids if id not in waiting]
+        if waiting:
+            self.metrics.increment('caas_batch_ids_coalesced_total', len(waiting))
+
+        entities = []
+        if ids:
+            future = asyncio.get_event_loop().create_future()
+            for id in ids:
+                self.in_flight[id] = future
+            try:
+                self.logger.info('querying CaaS via client.get_batch()...')
+                response = await self._run(self._send_batch, self._construct_batch_params(ids))
+                entities = self._cache_entities(self._handle_response(response))
+                future.set_result(entities)
+            except Exception as e:
+                future.set_exception(e)
+                # mark it retrieved, asyncio would complain about it if no other call was waiting
+                future.exception()
+                raise
+            finally:
+                if not future.done():
+                    future.cancel()
+                for id in ids:
+                    del self.in_flight[id]
+
+        results = await asyncio.gather(*set(waiting.values()))
+
+        return cached + entities + [entity for result in results for entity in result if entity['$']['id'] in waiting]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+# bounded-memory store of the caas ids seen during a query
+# 10/18/26
+# updated 10/18/26
+
+import os
+import math
+import sqlite3
+import hashlib
+import tempfile
+
+
+class SqliteIdStore:
+    '''exact, disk-backed set of ids. the file is temporary and removed by close()'''
+
+    def __init__(self, path=None):
+        if path:
+            self.path = path
+        else:
+            fd, self.path = tempfile.mkstemp(suffix='.sqlite', prefix='dedupe_')
+            os.close(fd)
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY)')
+
+    def add(self, id):
+        '''add id to the store, returning False if it was already in there'''
+        return self.conn.execute('INSERT OR IGNORE INTO ids (id) VALUES (?)', (id,)).rowcount == 1
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+
+class BloomFilter:
+    '''
+    fixed size, probabilistic set of ids. sized for expected_ids at the given
+    false_positive_rate, so memory never grows past that. it never misses an id that
+    was added, but a small fraction of new ids are reported as already seen.
+    '''
+
+    def __init__(self, expected_ids, false_positive_rate):
+        self.num_bits = max(8, int(-expected_ids * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / expected_ids * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, id):
+        '''derive num_hashes bit positions from two halves of a single digest'''
+        digest = hashlib.blake2b(id.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, id):
+        '''add id to the filter, returning False if it (probably) was already in there'''
+        new = False
+        for position in self._positions(id):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+
+        return new
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DedupeStore:
+    '''
+    remembers the caas ids seen during a query within a fixed memory budget.
+    ids are kept in an exact in-memory set until it holds max_ids of them, then
+    they're all moved to the spill store, which takes every id after that:
+
+    'disk' spills to an exact sqlite set in a temporary file
+    'bloom' spills to a bloom filter with a false_positive_rate chance of dropping
+    a new entity as a dupe. it's sized for expected_ids, which should be set to
+    at least the number of results the query returns.
+
+    add() is the only way in, so it's safe to call while a page's records are being filtered
+    '''
+
+    spills = ['disk', 'bloom']
+    max_ids = 1000000
+    expected_ids = 10000000
+    false_positive_rate = 0.001
+
+    def __init__(self, spill='disk', max_ids=max_ids, expected_ids=expected_ids,
+                 false_positive_rate=false_positive_rate, logger=None):
+        if spill not in self.spills:
+            raise ValueError('spill should be one of {}'.format(', '.join(self.spills)))
+
+        self.spill = spill
+        self.max_ids = max_ids
+        self.expected_ids = expected_ids
+        self.false_positive_rate = false_positive_rate
+        self.logger = logger
+        self.ids = set()
+        self.store = None
+        self.count = 0
+
+    def _init_store(self):
+        if self.spill == 'disk':
+            return SqliteIdStore()
+        else:
+            return BloomFilter(self.expected_ids, self.false_positive_rate)
+
+    def _spill(self):
+        if self.logger:
+            self.logger.info('{} caas ids seen, moving them to the {} dedupe store'.format(len(self.ids), self.spill))
+
+        self.store = self._init_store()
+        for id in self.ids:
+            self.store.add(id)
+        self.store.flush()
+        self.ids = set()
+
+    def add(self, caas_id):
+        '''add caas_id to the store, returning False if it was already seen'''
+        if self.store:
+            new = self.store.add(caas_id)
+        elif caas_id in self.ids:
+            new = False
+        else:
+            self.ids.add(caas_id)
+            new = True
+            if len(self.ids) > self.max_ids:
+                self._spill()
+
+        self.count += new
+        return new
+
+    def flush(self):
+        '''commit anything the spill store is holding back, call it once per page'''
+        if self.store:
+            self.store.flush()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.store:
+            self.store.close()
@@ -0,0 +1,108 @@
+# persistent local cache of CaaS entities keyed by CaaS id
+# 10/18/26
+# updated 10/18/26
+
+import json
+import sqlite3
+import threading
+from time import time
+
+
+class EntityCache:
+    '''
+    sqlite backed cache that sits in front of CaaSClient.get_batch() and stores the
+    entities that CaaSClient.search() returns, so repeat and overlapping queries can
+    be served locally instead of going back to CaaS.
+
+    entries older than ttl seconds count as misses, and are dropped every
+    expire_interval seconds. once the cache holds more than max_entries entities,
+    the oldest ones are evicted. the number of entries is counted once when the
+    cache is opened and kept up to date from then on, so storing a page never has
+    to scan the table. hits and misses count id lookups since the cache was opened.
+
+    the connection is shared between threads, so every call goes through self.lock
+    '''
+
+    path = 'entity_cache.sqlite'
+    ttl = 60 * 60 * 24 * 7
+    max_entries = 500000
+    expire_interval = 60
+
+    def __init__(self, path=path, ttl=ttl, max_entries=max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired_at = 0
+        self.lock = threading.Lock()
+        self.conn = self._init_db()
+        self.count = self.conn.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+
+    def _init_db(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('CREATE TABLE IF NOT EXISTS entities (id TEXT PRIMARY KEY, stored REAL, entity TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS entities_stored ON entities (stored)')
+        conn.commit()
+
+        return conn
+
+    def _evict(self):
+        '''drop expired entries if expire_interval has passed, then the oldest entries past max_entries'''
+        now = time()
+        if now - self.expired_at >= self.expire_interval:
+            self.count -= self.conn.execute('DELETE FROM entities WHERE stored < ?', (now - self.ttl,)).rowcount
+            self.expired_at = now
+
+        excess = self.count - self.max_entries
+        if excess > 0:
+            self.count -= self.conn.execute(
+                'DELETE FROM entities WHERE id IN (SELECT id FROM entities ORDER BY stored LIMIT ?)', (excess,)).rowcount
+
+    def _count_stored(self, ids):
+        '''how many of ids already have an entry, fresh or not'''
+        stored = 0
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            stored += self.conn.execute('SELECT COUNT(*) FROM entities WHERE id IN ({})'.format(','.join('?' * len(chunk))),
+                                        chunk).fetchone()[0]
+
+        return stored
+
+    def get_many(self, ids):
+        '''return a dict of id: entity for every id that has a fresh entry in the cache'''
+        found = {}
+        oldest = time() - self.ttl
+
+        with self.lock:
+            # stay well under sqlite's limit on the number of query parameters
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self.conn.execute(
+                    'SELECT id, entity FROM entities WHERE stored >= ? AND id IN ({})'.format(','.join('?' * len(chunk))),
+                    [oldest] + chunk)
+                found.update((id, json.loads(entity)) for id, entity in rows)
+
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+
+        return found
+
+    def put_many(self, entities):
+        '''store entities by their '$' id, replacing any existing entries'''
+        now = time()
+        rows = {entity['$']['id']: (entity['$']['id'], now, json.dumps(entity)) for entity in entities}
+
+        with self.lock:
+            # replaced entries don't add to the count
+            self.count += len(rows) - self._count_stored(list(rows))
+            self.conn.executemany('INSERT OR REPLACE INTO entities (id, stored, entity) VALUES (?, ?, ?)', rows.values())
+            self._evict()
+            self.conn.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,29 +1,13 @@
 #!/usr/local/bin/python3
 # get CaaS conent ID by URL
 # 5/25/18
-# updated 6/26/18
+# updated 10/18/26
 
 import gspreadsheet
-from time import sleep
 from collections import Counter, namedtuple
 from client_wrapper import CaaSClient
 
 
-# example elastic search request from caas client documentation for finding content by url
-elastic_search_request = {
-    "size": 50,
-    "query": {
-        "constant_score": {
-            "filter": {
-                "term": {
-                    "web_article_url.raw": "http://www.instyle.com/hair/find-best-hair-color-your-skin-tone"
-                }
-            }
-        }
-    }
-}
-
-
 def get_column_values(worksheet, column_name):
     '''get values from a specific column in a google spreadsheet'''
     title_cell = worksheet.find(column_name)
@@ -43,10 +27,10 @@ def update_sources(source_dict, source):
     return source_dict
 
 
-def _get_cell_value(row, column_key):
-    '''sleep here so we don't exceed the 1 request per second quota for the sheets API'''
-    sleep(1)
-    return content.cell(row, columns[column_key]).value
+def read_rows(snapshot):
+    '''return a dict of row number: Row for every row of the worksheet snapshot'''
+    return {i: Row(**{key: snapshot.get(i, column) for key, column in columns.items()})
+            for i in range(1, len(snapshot) + 1)}
 
 
 def _parse_ids(ids, response, key):
@@ -66,14 +50,14 @@ def get_caas_ids(response):
     return {response[n]['$']['id'] for n in range(len(response)) if 'id' in response[n]['$'].keys()}
 
 
-def update_sheet(cms_ids, caas_ids, response):
+def update_sheet(row_number, cms_ids, caas_ids, response):
+    '''buffer the ids found for a row, they're written when the snapshot is flushed'''
     for ids, key in zip([cms_ids, caas_ids], ['cms_id', 'caas_id']):
         if ids:
             id = _parse_ids(ids, response, key)
             if id != 'None':
                 print('found {} {}'.format(key, id))
-                print('updating spreadsheet...')
-                content.update_cell(i, columns[key], id)
+                content.set(row_number, columns[key], id)
         else:
             print("didn't find any {} ids".format(key))
 
@@ -96,14 +80,11 @@ if __name__ == '__main__':
 
     sheet_title = 'Hair Classification Training Corpus'
     hair = g.get_spreadsheet(title=sheet_title)
-    content = g.get_worksheet(hair, 'Terms/Content')
-
-    # iterate through the worksheet's rows
-    for i in range(1, content.row_count + 1):
-        print('checking row {}'.format(i))
-        row = Row(source=_get_cell_value(i, 'source'), caas_id=_get_cell_value(i, 'caas_id'),
-                  cms_id=_get_cell_value(i, 'cms_id'), url=_get_cell_value(i, 'url'))
+    content = g.get_snapshot(hair, 'Terms/Content')
 
+    # iterate through the worksheet's rows, collecting the ones that need looking up
+    rows = {}
+    for i, row in read_rows(content).items():
         #  don't search for ids we've already found
         if not row.caas_id or not row.cms_id:
             if row.url.startswith('http'):
@@ -113,21 +94,26 @@ if __name__ == '__main__':
 
                 url_sources = update_sources(url_sources, row.source)
                 search_totals['searched'] += 1
-
-                print('\nsearching for {}'.format(row.url))
-                elastic_search_request["query"]["constant_score"]["filter"]["term"]["web_article_url.raw"] = row.url
-                response = caas_client.search(elastic_request=elastic_search_request)
-
-                if response:
-                    url_sources[row.source]['found'] += 1
-                    search_totals['found'] += 1
-
-                    # make a set of the cms id's from the entities in the response
-                    cms_ids = get_cms_ids(response)
-                    caas_ids = get_caas_ids(response)
-                    update_sheet(cms_ids, caas_ids, response)
-
-                sleep(0.1)
+                rows[i] = row
+
+    # look all of the urls up at once, a few hundred to a query
+    print('\nsearching for {} urls'.format(len(rows)))
+    found, not_found = caas_client.resolve_urls(list({row.url for row in rows.values()}))
+
+    for i, row in rows.items():
+        response = found.get(row.url)
+        if response:
+            url_sources[row.source]['found'] += 1
+            search_totals['found'] += 1
+
+            # make a set of the cms id's from the entities in the response
+            cms_ids = get_cms_ids(response)
+            caas_ids = get_caas_ids(response)
+            print('\nrow {}: {}'.format(i, row.url))
+            update_sheet(i, cms_ids, caas_ids, response)
+
+    # the snapshot writes its buffer back whenever max_buffered cells pile up, this writes the rest
+    content.flush()
 
     print(url_sources)
     print(search_totals)
@@ -1,7 +1,7 @@
 #!/usr/local/bin/python3
 # gspread functions
 # 7/31/17
-# updated 5/25/18
+# updated 10/18/26
 
 import os
 import sys
@@ -10,9 +10,114 @@ import gspread
 import logging
 import logging.config
 import caas_keys
+from time import sleep, monotonic
 from oauth2client.service_account import ServiceAccountCredentials
 
 
+class WorksheetSnapshot(object):
+    '''
+    local copy of a worksheet, read with a single get_all_values() call.
+    cells are looked up by row number and either a 1-based column number or a
+    header name from header_row. if key_column is given, rows can also be found
+    by the value in that column.
+
+    set() edits the local copy and buffers the cell, and flush() writes every
+    buffered cell in a single update_cells() call. writes are spaced at least
+    write_interval seconds apart, to stay under the sheets API quota, and
+    buffered cells are flushed automatically once there are max_buffered of them.
+    '''
+
+    write_interval = 1.0
+    max_buffered = 1000
+
+    def __init__(self, worksheet, key_column=None, header_row=1, logger=None):
+        self.worksheet = worksheet
+        self.key_column = key_column
+        self.header_row = header_row
+        self.logger = logger if logger else logging.getLogger('gsheet')
+        self.buffered = {}
+        self.last_write = None
+        self.reload()
+
+    def reload(self):
+        '''read the worksheet again, dropping anything that hasn't been flushed'''
+        self.values = self.worksheet.get_all_values()
+        self.buffered = {}
+        header = self.values[self.header_row - 1] if len(self.values) >= self.header_row else []
+        self.headers = {name: col for col, name in enumerate(header, start=1) if name}
+        self._index_keys()
+        self.logger.info('read {} rows from worksheet {}'.format(len(self.values), self.worksheet.title))
+
+    def _index_keys(self):
+        self.keys = {}
+        if self.key_column is None:
+            return
+
+        col = self._col(self.key_column)
+        for row in range(self.header_row + 1, len(self.values) + 1):
+            key = self.get(row, col)
+            if key:
+                self.keys.setdefault(key, row)
+
+    def _col(self, column):
+        return column if isinstance(column, int) else self.headers[column]
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, row, column):
+        '''the value of a cell, '' if it's beyond the end of the sheet's data'''
+        values = self.values[row - 1] if row <= len(self.values) else []
+        col = self._col(column)
+
+        return values[col - 1] if col <= len(values) else ''
+
+    def row(self, row):
+        '''a row as a dict of header name: value'''
+        return {name: self.get(row, col) for name, col in self.headers.items()}
+
+    def rows(self):
+        '''yield (row number, row dict) for every row below the header'''
+        for row in range(self.header_row + 1, len(self.values) + 1):
+            yield row, self.row(row)
+
+    def find(self, key):
+        '''the number of the first row with key in key_column, or None'''
+        return self.keys.get(key)
+
+    def set(self, row, column, value):
+        col = self._col(column)
+        while len(self.values) < row:
+            self.values.append([])
+        values = self.values[row - 1]
+        values.extend([''] * (col - len(values)))
+        values[col - 1] = value
+        self.buffered[(row, col)] = value
+
+        if self.key_column is not None and col == self._col(self.key_column) and value:
+            self.keys.setdefault(value, row)
+        if len(self.buffered) >= self.max_buffered:
+            self.flush()
+
+    def flush(self):
+        '''write the buffered cells, returning how many there were'''
+        if not self.buffered:
+            return 0
+
+        if self.last_write is not None:
+            wait = self.write_interval - (monotonic() - self.last_write)
+            if wait > 0:
+                sleep(wait)
+
+        cells = [gspread.Cell(row, col, value) for (row, col), value in sorted(self.buffered.items())]
+        self.logger.info('writing {} cells to worksheet {}'.format(len(cells), self.worksheet.title))
+        self.worksheet.update_cells(cells)
+        self.last_write = monotonic()
+        self.buffered = {}
+
+        return len(cells)
+
+
 class Gsheet(object):
     '''methods for interacting with Google Drive spreadsheets'''
 
@@ -78,3 +183,8 @@ class Gsheet(object):
     def get_worksheet(self, gsheet, title):
         '''return a specific tab in the spreadsheet as a gspread worksheet'''
         return gsheet.worksheet(title)
+
+    def get_snapshot(self, gsheet, title, key_column=None, header_row=1):
+        '''return a specific tab in the spreadsheet as a WorksheetSnapshot'''
+        return WorksheetSnapshot(self.get_worksheet(gsheet, title), key_column=key_column,
+                                 header_row=header_row, logger=self.logger)
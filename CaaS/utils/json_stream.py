@@ -0,0 +1,126 @@
+# incremental decoding of CaaS search responses
+# 10/18/26
+# updated 10/18/26
+
+'''
+response.json() decodes the text of a whole search response into one document,
+so a page briefly holds the raw body, its decoded text and every entity in full,
+"web_article_content" and "pronto" payloads included. decode_search_response()
+builds the same document, but can keep just the entity fields we use.
+
+backends:
+'ijson' decodes the body one entity and hit at a time, so only the kept fields of
+        each entity stay in memory. needs pip3 install ijson, which uses its C
+        (yajl2_c) backend when it's available
+'orjson' decodes the whole body at once, straight from bytes and several times
+        faster than json. needs pip3 install orjson
+'json' decodes the whole body at once with the standard library
+'auto' uses the first of these that's installed
+
+ijson only keeps the whole body out of memory if the request was sent with
+stream=True, so the body is still on the connection when it's decoded. otherwise
+requests has already read all of it into response.content.
+'''
+
+import io
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+backends = ['ijson', 'orjson', 'json']
+
+# where the items we keep live in a search response, as ijson prefixes
+ITEM_PREFIXES = {'entities.item': 'entities', 'hits.hits.item': 'hits'}
+CONTAINERS = ('start_map', 'start_array')
+CONTAINER_ENDS = ('end_map', 'end_array')
+
+
+def available_backend(backend='auto'):
+    '''return backend if it's installed, or the first installed backend for 'auto', else raise ImportError'''
+    installed = {'ijson': ijson is not None, 'orjson': orjson is not None, 'json': True}
+    if backend == 'auto':
+        return next(name for name in backends if installed[name])
+    if backend not in installed:
+        raise ValueError('backend should be one of auto, {}'.format(', '.join(backends)))
+    if not installed[backend]:
+        raise ImportError('the {0} json backend needs pip3 install {0}'.format(backend))
+
+    return backend
+
+
+def slim(entity, fields):
+    '''entity with only the keys in fields, or all of it if fields is None'''
+    return entity if fields is None else {key: entity[key] for key in fields if key in entity}
+
+
+def iter_search_response(source):
+    '''
+    yield tuple formatted (kind, value) from a search response as it's decoded with
+    ijson, where kind is 'found', 'entity' or 'hit'. source is a file-like object
+    '''
+    builder = None
+    for prefix, event, value in ijson.parse(source, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            depth += 1 if event in CONTAINERS else -1 if event in CONTAINER_ENDS else 0
+            if not depth:
+                yield kind, builder.value
+                builder = None
+        elif prefix == 'found':
+            yield 'found', value
+        elif prefix in ITEM_PREFIXES and event in CONTAINERS:
+            kind = 'entity' if ITEM_PREFIXES[prefix] == 'entities' else 'hit'
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+
+
+def is_streamed(response):
+    '''whether response was sent with stream=True and its body hasn't been read yet'''
+    return not getattr(response, '_content_consumed', True) and getattr(response, 'raw', None) is not None
+
+
+def _source(response):
+    '''
+    a file-like object to decode the response body from. if the response is still
+    being streamed, its body is read straight off the connection, and the
+    connection goes back to the pool once all of it has been read
+    '''
+    if is_streamed(response):
+        response.raw.decode_content = True
+        return response.raw
+
+    return io.BytesIO(response.content)
+
+
+def decode_search_response(response, backend='auto', fields=None):
+    '''
+    return the body of a search response as a dict formatted
+    {'found': n, 'entities': [...], 'hits': {'hits': [...]}}, with each entity cut
+    down to fields unless fields is None
+    '''
+    backend = available_backend(backend)
+
+    if backend == 'ijson':
+        data = {'found': 0, 'entities': [], 'hits': {'hits': []}}
+        for kind, value in iter_search_response(_source(response)):
+            if kind == 'found':
+                data['found'] = value
+            elif kind == 'entity':
+                data['entities'].append(slim(value, fields))
+            else:
+                data['hits']['hits'].append(value)
+        return data
+
+    data = orjson.loads(response.content) if backend == 'orjson' else json.loads(response.content)
+    data['entities'] = [slim(entity, fields) for entity in data.get('entities', [])]
+
+    return data
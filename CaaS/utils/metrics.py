@@ -0,0 +1,175 @@
+# counters, histograms and trace spans for timing CaaS queries
+# 10/18/26
+# updated 10/18/26
+
+'''
+a Metrics instance is shared by a CaaSClient and caas_query.py. the client records
+request latency, response size, retries and rate limiter waits for every call it
+makes, and caas_query.py times the stages of each page, so a run's summary shows
+whether CaaS, nlp enrichment or writing the output is what's holding it up.
+
+metrics are named and labelled like prometheus metrics, and write() saves them as
+a prometheus text file (.prom) or a json summary (anything else). with tracing on,
+every timed call is also kept as a span, which write_trace() saves as json lines.
+'''
+
+import json
+import threading
+from contextlib import contextmanager
+from time import time, monotonic
+
+
+class Histogram:
+    '''
+    counts of observed values in cumulative buckets, like a prometheus histogram.
+    the sum, min and max are kept exactly, quantiles are estimated from the buckets
+    '''
+
+    # seconds, from 1ms to 1 minute
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        '''the upper bound of the bucket holding the q quantile, capped at the largest value seen'''
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+
+class Metrics:
+    '''
+    thread-safe registry of counters and histograms, keyed by name and labels.
+    histograms whose name ends with "_seconds" use Histogram.buckets, anything
+    else (sizes and counts) uses size_buckets.
+    '''
+
+    size_buckets = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000, 5000000)
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.trace = trace
+        self.spans = []
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram() if name.endswith('_seconds') else Histogram(self.size_buckets)
+            self.histograms[key].observe(value)
+
+    def add_span(self, name, start, duration, **attributes):
+        '''keep a finished span if tracing is on. start is a unix timestamp'''
+        if self.trace:
+            span = {'name': name, 'start': start, 'duration': duration, 'thread': threading.current_thread().name}
+            span.update(attributes)
+            with self.lock:
+                self.spans.append(span)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''observe how long the block took in the name histogram, and trace it as a span'''
+        started = time()
+        start = monotonic()
+        try:
+            yield
+        finally:
+            duration = monotonic() - start
+            self.observe(name, duration, **labels)
+            self.add_span(name, started, duration, **labels)
+
+    def _label_string(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}' if labels else ''
+
+    def to_prometheus(self):
+        '''the metrics in the prometheus text exposition format'''
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}{} {}'.format(name, self._label_string(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, self._label_string(labels, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, self._label_string(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, self._label_string(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        '''json-ready summary, with each metric's labels folded into its key'''
+        with self.lock:
+            return {
+                'counters': {name + self._label_string(labels): value for (name, labels), value in sorted(self.counters.items())},
+                'histograms': {name + self._label_string(labels): histogram.summary()
+                               for (name, labels), histogram in sorted(self.histograms.items())}
+            }
+
+    def write(self, path):
+        '''save the metrics to path, in the prometheus text format if it ends with .prom, otherwise as json'''
+        with open(path, 'w') as metrics_file:
+            if path.endswith('.prom'):
+                metrics_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), metrics_file, indent=2)
+
+    def write_trace(self, path):
+        '''save the spans to path as json lines, in the order they started'''
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+
+        with open(path, 'w') as trace_file:
+            for span in spans:
+                trace_file.write(json.dumps(span) + '\n')
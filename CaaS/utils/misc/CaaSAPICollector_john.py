@@ -12,46 +12,39 @@ import json
 import csv
 from datetime import datetime, timedelta
 from hashlib import md5
+from url_extractor import UrlExtractor, UrlFile
+from content_store import ContentStore
+from manifest import Manifest
 
 entity_service_client = client.EntityServiceClient('prod')
 entity_service_client.x_api_key = CAAS_API_KEY_PROD
+content_store = ContentStore('content_and_tags.sqlite')
+manifest = Manifest('collector_manifest.sqlite')
+
+
+def redshift_connection():
+    # url_extractor needs its own connection per day table, DBAccess only hands out cursors
+    return redshift.DBAccess().get_cursor().connection
 
 
 def collect_content_urls(toplevel_domain='instyle.com', historical_day_count=90): 
-    days = historical_day_count
-    dba = redshift.DBAccess()
-    unique_urls = set()
-    local_url_dump = open('instyle_urls.txt','wb')
-    cursor = dba.get_cursor()
-    sql = """select clean_url from _360.ti_cookie_v6_%Y_%m_%d where "domain" = '""" + toplevel_domain + """' group by clean_url having count(*) > 35"""
-    for d in range(1,days):
-        extract_date = datetime.now() - timedelta(days = d)
-        cursor.execute(extract_date.strftime(sql))
-        for res in cursor.fetchall():
-            if res[0] not in unique_urls:
-                unique_urls.add(res[0])
-        print datetime.now()
-        print len(unique_urls)
-        open(toplevel_domain + 'urls.txt','wb').write("\n".join(list(unique_urls)))
-    return unique_urls
+    url_file = UrlFile(toplevel_domain + 'urls.txt')
+    extractor = UrlExtractor(redshift_connection)
+    extractor.extract(toplevel_domain, datetime.now() - timedelta(days=historical_day_count - 1),
+                      datetime.now() - timedelta(days=1), url_file)
+    url_file.close()
+    print datetime.now()
+    print len(url_file.urls)
+    return url_file.urls
 
 def collect_content_urls_n(unique_urls=set(), processed_urls=set(), toplevel_domain='instyle.com', start=datetime.now(), end = datetime.now()): 
     
-    dba = redshift.DBAccess()
-    unique_urls = set()
-    local_url_dump = open('instyle_urls.txt','wb')
-    cursor = dba.get_cursor()
-    sql = """select clean_url from _360.ti_cookie_v6_%Y_%m_%d where "domain" = '""" + toplevel_domain + """' group by clean_url having count(*) > 35"""
-    while start <= end:
-        
-        cursor.execute(start.strftime(sql))
-        for res in cursor.fetchall():
-            if res[0] not in processed_urls:
-                unique_urls.add(res[0])
-        print datetime.now(), len(unique_urls)
-        open(toplevel_domain + 'urls_extended.txt','wb').write("\n".join(list(unique_urls)))
-        start += timedelta(days=1)
-    return unique_urls
+    url_file = UrlFile(toplevel_domain + 'urls_extended.txt', exclude=processed_urls)
+    extractor = UrlExtractor(redshift_connection)
+    extractor.extract(toplevel_domain, start, end, url_file)
+    url_file.close()
+    print datetime.now(), len(url_file.urls)
+    return url_file.urls
 
 fin  = open('instyle_urls.txt','rbU')
 reader=csv.reader(fin)
@@ -180,12 +173,10 @@ def add_hash_to_record(recobj):
 
 url='https://www.coastalliving.com/travel/rentals/bali-villa-vacation-rental'
 print 'ssss'
-def iterate(unique_urls, skip = 296):
-    
-    #print 'skipping ', skip
-
-    for i in range(skip,len(unique_urls)):
-        url = unique_urls[i]
+def iterate(unique_urls, manifest, retry_errors=False):
+    # urls already in the manifest are skipped, whatever order unique_urls is in.
+    # errors are only tried again with retry_errors
+    for url in manifest.pending(unique_urls, retry_errors=retry_errors):
         if url is None or len(url.strip()) == 0:
             print 'no url'
             continue
@@ -199,9 +190,16 @@ def iterate(unique_urls, skip = 296):
 
         
         
-        print i,  'collect', formatted_url
+        print 'collect', formatted_url
         
-        data = collect_data(formatted_url)
+        try:
+            data = collect_data(formatted_url)
+        except Exception as e:
+            print 'error', formatted_url, e
+            manifest.mark(url, 'error')
+            continue
+
+        manifest.mark(url, 'found' if data else 'not_found')
 
 def collect_data(url):
 
@@ -218,6 +216,7 @@ def collect_data(url):
         return None
 
     
+    records = []
     for caas_record_url in caas_records:
         s = datetime.now()
         enrich_cass_record_stored_annotations(caas_records[caas_record_url])
@@ -228,11 +227,14 @@ def collect_data(url):
             print 'sleep', .2 - (e-s).microseconds*10**-6        
             
         if add_hash_to_record(caas_records[caas_record_url]): 
-            print 'write ', 'content_and_tags/' + caas_records[caas_record_url]['url_md5'] + ".json"
-            #print caas_records[caas_record_url].keys()
-            open('content_and_tags/' + caas_records[caas_record_url]['url_md5'] + ".json",'wb').write(json.dumps(caas_records[caas_record_url]))
+            print 'write ', caas_records[caas_record_url]['url_md5']
+            records.append(caas_records[caas_record_url])
+
+    content_store.put_many(records)
     return caas_records
 
 
-iterate(unique_urls,skip=20545)
+iterate(unique_urls, manifest)
+iterate(manifest.errors(), manifest, retry_errors=True)
+print manifest.counts()
 
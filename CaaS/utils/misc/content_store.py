@@ -0,0 +1,113 @@
+# packed store for the enriched caas records written by the collectors
+# 10/18/26
+# updated 10/18/26
+
+'''
+a single sqlite file in place of a content_and_tags/<url_md5>.json file per record.
+records are stored as zlib compressed json keyed by their url_md5, so they can be
+looked up one at a time by hash or scanned in the order they were stored.
+works under python 2.7 and 3.
+
+pack an existing directory of json files into a store with:
+
+python content_store.py content_and_tags content_and_tags.sqlite
+'''
+
+import os
+import sys
+import json
+import zlib
+import sqlite3
+
+
+class ContentStore(object):
+    '''
+    dict-like store of records by url_md5: store[url_md5], url_md5 in store, len(store).
+    put_many() writes a batch of records in a single transaction, replacing any
+    record with the same url_md5.
+    '''
+
+    path = 'content_and_tags.sqlite'
+    compression_level = 6
+
+    def __init__(self, path=path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS records (url_md5 TEXT PRIMARY KEY, record BLOB)')
+        self.conn.commit()
+
+    def _pack(self, record):
+        data = json.dumps(record)
+        data = data if isinstance(data, bytes) else data.encode('utf-8')
+
+        return sqlite3.Binary(zlib.compress(data, self.compression_level))
+
+    def _unpack(self, packed):
+        return json.loads(zlib.decompress(bytes(packed)).decode('utf-8'))
+
+    def put_many(self, records):
+        '''store records that have a url_md5, returning how many were stored'''
+        rows = [(record['url_md5'], self._pack(record)) for record in records if record.get('url_md5')]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO records (url_md5, record) VALUES (?, ?)', rows)
+
+        return len(rows)
+
+    def get(self, url_md5, default=None):
+        row = self.conn.execute('SELECT record FROM records WHERE url_md5 = ?', (url_md5,)).fetchone()
+        return self._unpack(row[0]) if row else default
+
+    def __getitem__(self, url_md5):
+        record = self.get(url_md5)
+        if record is None:
+            raise KeyError(url_md5)
+
+        return record
+
+    def __contains__(self, url_md5):
+        return self.conn.execute('SELECT 1 FROM records WHERE url_md5 = ?', (url_md5,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def scan(self, batch_size=1000):
+        '''yield every record in the order they were last stored, reading batch_size at a time'''
+        cursor = self.conn.execute('SELECT record FROM records ORDER BY rowid')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._unpack(row[0])
+
+    def close(self):
+        self.conn.close()
+
+
+def pack_json_dir(directory, store, batch_size=1000):
+    '''add every <url_md5>.json file in directory to store, returning how many were added'''
+    batch = []
+    count = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+
+        with open(os.path.join(directory, name), 'rb') as json_file:
+            record = json.loads(json_file.read().decode('utf-8'))
+        record.setdefault('url_md5', name[:-len('.json')])
+        batch.append(record)
+
+        if len(batch) >= batch_size:
+            count += store.put_many(batch)
+            batch = []
+
+    return count + store.put_many(batch)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        raise SystemExit('usage: python content_store.py content_and_tags/ content_and_tags.sqlite')
+
+    store = ContentStore(sys.argv[2])
+    print('packed {} records into {}'.format(pack_json_dir(sys.argv[1], store), sys.argv[2]))
+    store.close()
@@ -10,11 +10,13 @@ import redshift, time
 
 from datetime import datetime, timedelta
 import json
+from content_store import ContentStore
 
 
 CAAS_API_KEY_PROD = """YOUR CAAS API KEY"""
 entity_service_client = client.EntityServiceClient('prod')
 entity_service_client.x_api_key = CAAS_API_KEY_PROD
+content_store = ContentStore('content_and_tags.sqlite')
 
 
 ## the following modules extract unique URLS from the TimeInc cookie logs
@@ -173,6 +175,7 @@ def collect_data(url):
         print 'sleep', .2 - (e-s).microseconds*10**-6
     caas_records = extract_caas_record(caas_data)
 
+    records = []
     for caas_record_url in caas_records:
         s = datetime.now()
         enrich_cass_record_stored_annotations(caas_records[caas_record_url])
@@ -183,9 +186,11 @@ def collect_data(url):
             print 'sleep', .2 - (e-s).microseconds*10**-6
 
         add_hash_to_record(caas_records[caas_record_url])
-        print 'write ', 'content_and_tags/' + caas_records[caas_record_url]['url_md5'] + ".json"
+        print 'write ', caas_records[caas_record_url]['url_md5']
         print caas_records[caas_record_url].keys()
-        open('content_and_tags/' + caas_records[caas_record_url]['url_md5'] + ".json",'wb').write(json.dumps(caas_records[caas_record_url]))
+        records.append(caas_records[caas_record_url])
+
+    content_store.put_many(records)
     return caas_records
 
 
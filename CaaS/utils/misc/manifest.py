@@ -0,0 +1,70 @@
+# manifest of the urls a collector has processed and how each one went
+# 10/18/26
+# updated 10/18/26
+
+'''
+lets a collector pick up where it left off no matter how its input is ordered.
+every url is recorded by the md5 of the url with its outcome: 'found',
+'not_found' or 'error'. found and not_found urls are finished and skipped on
+the next run, while errors are kept apart so they can be retried on their own.
+works under python 2.7 and 3.
+'''
+
+import sqlite3
+from time import time
+from hashlib import md5
+
+
+class Manifest(object):
+    '''sqlite backed record of processed urls, every mark() is committed straight away'''
+
+    path = 'collector_manifest.sqlite'
+    outcomes = ['found', 'not_found', 'error']
+    finished = ['found', 'not_found']
+
+    def __init__(self, path=path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS urls '
+                          '(url_md5 TEXT PRIMARY KEY, url TEXT, outcome TEXT, attempts INTEGER, updated REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS urls_outcome ON urls (outcome)')
+        self.conn.commit()
+
+    @staticmethod
+    def url_hash(url):
+        return md5(url.encode('utf-8') if not isinstance(url, bytes) else url).hexdigest()
+
+    def outcome(self, url):
+        '''the outcome recorded for url, or None if it hasn't been processed'''
+        row = self.conn.execute('SELECT outcome FROM urls WHERE url_md5 = ?', (self.url_hash(url),)).fetchone()
+        return row[0] if row else None
+
+    def mark(self, url, outcome):
+        if outcome not in self.outcomes:
+            raise ValueError('outcome should be one of {}'.format(', '.join(self.outcomes)))
+
+        url_md5 = self.url_hash(url)
+        # python 2 reads urls from csv files as byte strings, which sqlite won't take
+        url = url.decode('utf-8') if isinstance(url, bytes) else url
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO urls (url_md5, url, attempts) VALUES (?, ?, 0)', (url_md5, url))
+            self.conn.execute('UPDATE urls SET outcome = ?, attempts = attempts + 1, updated = ? WHERE url_md5 = ?',
+                              (outcome, time(), url_md5))
+
+    def pending(self, urls, retry_errors=False):
+        '''yield the urls that haven't been finished, including the errors if retry_errors. blank urls are dropped'''
+        skip = self.finished if retry_errors else self.outcomes
+        for url in urls:
+            if url and url.strip() and self.outcome(url) not in skip:
+                yield url
+
+    def errors(self):
+        '''the urls whose last attempt was an error'''
+        return [row[0] for row in self.conn.execute("SELECT url FROM urls WHERE outcome = 'error' ORDER BY updated")]
+
+    def counts(self):
+        '''dict of outcome: number of urls'''
+        return dict(self.conn.execute('SELECT outcome, COUNT(*) FROM urls GROUP BY outcome'))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,153 @@
+# stream content urls out of the daily cookie tables in redshift
+# 10/18/26
+# updated 10/18/26
+
+'''
+works under python 2.7 and 3, since the collectors in this directory are python 2.
+
+connect is any function returning a new DB-API connection, e.g. psycopg2.connect
+with redshift's credentials, or sqlite3.connect for a local stand-in. each day
+table is read over its own connection, batch_size rows at a time, through a named (server-side) cursor where the driver supports one, so a day's
+urls never have to fit in memory at once.
+'''
+
+import io
+import logging
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+class UrlFile(object):
+    '''
+    append-only text file of unique urls, one per line. the urls already in the file
+    are read once when it's opened, and add() only writes urls it hasn't seen.
+    '''
+
+    def __init__(self, path, exclude=()):
+        self.path = path
+        self.urls = set(self._read())
+        self.exclude = set(exclude)
+        self.outfile = io.open(path, 'a', encoding='utf-8')
+
+    def _read(self):
+        try:
+            with io.open(self.path, encoding='utf-8') as infile:
+                for line in infile:
+                    if line.strip():
+                        yield line.strip()
+        except IOError:
+            return
+
+    def add(self, urls):
+        '''write the urls that aren't in the file or excluded, returning them'''
+        new = []
+        for url in urls:
+            url = url.decode('utf-8') if isinstance(url, bytes) else url
+            if url and url not in self.urls and url not in self.exclude:
+                self.urls.add(url)
+                new.append(url)
+
+        if new:
+            self.outfile.write(u''.join(url + u'\n' for url in new))
+            self.outfile.flush()
+
+        return new
+
+    def close(self):
+        self.outfile.close()
+
+
+class UrlExtractor(object):
+    '''
+    runs the url query against a range of day tables, workers of them at a time,
+    and streams the results into a UrlFile. a day whose table is missing or whose
+    query fails with the driver's error is logged and skipped. anything else, like
+    failing to connect, is raised by extract() once the other days are done.
+
+    table is a strftime format for the name of a day's table and placeholder is
+    the driver's paramstyle marker ('%s' for psycopg2, '?' for sqlite3).
+    '''
+
+    table = '_360.ti_cookie_v6_%Y_%m_%d'
+    sql = 'select clean_url from {table} where "domain" = {placeholder} group by clean_url having count(*) > {placeholder}'
+    placeholder = '%s'
+    min_views = 35
+    workers = 4
+    batch_size = 10000
+
+    def __init__(self, connect, table=table, placeholder=placeholder, min_views=min_views,
+                 workers=workers, batch_size=batch_size, logger=None):
+        self.connect = connect
+        self.table = table
+        self.placeholder = placeholder
+        self.min_views = min_views
+        self.workers = workers
+        self.batch_size = batch_size
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+    def _open_cursor(self, conn, day):
+        '''a named cursor is a server-side cursor in psycopg2, drivers without them take no name'''
+        try:
+            return conn.cursor('urls_{}'.format(day.strftime('%Y%m%d')))
+        except TypeError:
+            return conn.cursor()
+
+    def _query_day(self, domain, day, batches):
+        '''put each batch of urls from a day's table on the batches queue, then None when it's done'''
+        sql = self.sql.format(table=day.strftime(self.table), placeholder=self.placeholder)
+
+        try:
+            conn = self.connect()
+            try:
+                cursor = self._open_cursor(conn, day)
+                cursor.execute(sql, (domain, self.min_views))
+                while True:
+                    rows = cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+                    batches.put([row[0] for row in rows])
+                cursor.close()
+                conn.commit()
+            except conn.Error as e:
+                self.logger.warning('skipping {}: {}'.format(day.strftime(self.table), e))
+                conn.rollback()
+            finally:
+                conn.close()
+        finally:
+            # the day is finished even if it failed, so extract() doesn't wait on it forever
+            batches.put(None)
+
+    def days(self, start, end):
+        day = start
+        while day <= end:
+            yield day
+            day += timedelta(days=1)
+
+    def extract(self, domain, start, end, url_file):
+        '''add the urls for domain from every day between start and end to url_file, returning how many were new'''
+        days = list(self.days(start, end))
+        batches = Queue(maxsize=self.workers * 2)
+        pool = ThreadPool(self.workers)
+        result = pool.map_async(lambda day: self._query_day(domain, day, batches), days)
+
+        new = 0
+        remaining = len(days)
+        while remaining:
+            batch = batches.get()
+            if batch is None:
+                remaining -= 1
+            else:
+                new += len(url_file.add(batch))
+
+        pool.close()
+        pool.join()
+        # raise the first error a worker hit, rather than passing its day off as done
+        result.get()
+
+        self.logger.info('found {} new urls for {} across {} days'.format(new, domain, len(days)))
+        return new
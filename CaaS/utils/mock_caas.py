@@ -0,0 +1,408 @@
+#!/usr/local/bin/python3
+# local stand-in for the CaaS search and get_batch endpoints
+# 10/18/26
+# updated 10/18/26
+
+'''
+serves a fixed set of entities over http the way CaaS does, so CaaSClient and
+caas_query.py can be run, tested and benchmarked without the production endpoint:
+
+python3 mock_caas.py --port 8800 --entities 10000 --latency 0.05
+
+then pass MockEntityClient('http://localhost:8800') to a CaaSClient as its entity_client.
+
+entities are generated from a seed, so every run serves the same data, or loaded
+from a json fixture holding a list of entities (nlp records included, they're just
+entities that other entities point to with "$i_nlp_source_google/watson" edges).
+
+search() understands the parts of the elasticsearch dsl our queries use: match_all,
+match, query_string, term, terms, range, exists, bool and constant_score, sorted by
+"_uid" or any entity field, with "size", "from", "search_after" and "_source" includes
+to return just some of each entity's fields. edges listed in the search's "follow"
+param come back with the entity they point to merged into them. every response
+is delayed by latency seconds plus up to jitter more, and throttle_rate of them are
+answered with a 429.
+'''
+
+import re
+import json
+import bisect
+import random
+import argparse
+import requests
+import threading
+from time import sleep, monotonic
+from functools import cmp_to_key
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# elasticsearch sorts entities missing a numeric sort field last, using these
+# as their sort values
+MISSING_DESC = -2 ** 63
+MISSING_ASC = 2 ** 63 - 1
+
+WORDS = ['hair', 'color', 'cut', 'style', 'beauty', 'celebrity', 'skin', 'makeup', 'summer',
+         'wedding', 'recipe', 'travel', 'fitness', 'fashion', 'trend', 'easy', 'best', 'guide']
+BRANDS = ['instyle', 'people', 'health', 'realsimple', 'southernliving', 'time']
+
+
+def generate_entities(count=1000, seed=0):
+    '''
+    return a list of count web_article entities plus the nlp records they point to.
+    most articles have a url, a "$date" and google and/or watson nlp edges, but a few
+    of each are missing, like in CaaS. edges carry a "$type" besides their "$id",
+    so an edge holding more than its id doesn't mean it was followed
+    '''
+    rng = random.Random(seed)
+    first_date = 1388534400000  # 1/1/2014
+    entities = []
+    nlp_records = []
+
+    for i in range(count):
+        title = ' '.join(rng.sample(WORDS, 5))
+        brand = rng.choice(BRANDS)
+        entity = {
+            '$': {'id': '{:032x}'.format(rng.getrandbits(128))},
+            'brand': brand,
+            'cms_id': str(100000 + i),
+            'web_article_title': title.title(),
+            'web_article_content': ' '.join(rng.choice(WORDS) for _ in range(300)),
+        }
+        if rng.random() > 0.05:
+            entity['web_article_url'] = 'http://www.{}.com/{}-{}'.format(brand, title.replace(' ', '-'), i)
+        if rng.random() > 0.02:
+            entity['$date'] = first_date + rng.randrange(5 * 365 * 24 * 60 * 60 * 1000)
+        if rng.random() < 0.7:
+            nlp_id = '{:032x}'.format(rng.getrandbits(128))
+            entity['$i_nlp_source_google'] = [{'$id': nlp_id, '$type': 'nlp_google'}]
+            nlp_records.append({'$': {'id': nlp_id}, 'nlp_categories': [
+                {'name': '/Beauty & Fitness/Hair Care', 'confidence': round(rng.uniform(0.5, 1), 2)}]})
+        if rng.random() < 0.6:
+            nlp_id = '{:032x}'.format(rng.getrandbits(128))
+            entity['$i_nlp_source_watson'] = [{'$id': nlp_id, '$type': 'nlp_watson'}]
+            nlp_records.append({'$': {'id': nlp_id}, 'nlp_categories': [
+                {'label': '/style and fashion/beauty/hair care', 'score': round(rng.uniform(0.5, 1), 2)}]})
+        entities.append(entity)
+
+    return entities + nlp_records
+
+
+def load_fixture(path):
+    with open(path) as fixture:
+        return json.load(fixture)
+
+
+class MockCaaS:
+    '''
+    the search and get_batch logic of the mock, without the http. entities are
+    searchable if they have a "web_article_title", and every entity can be fetched
+    by its '$' id with get_batch().
+
+    the matches for each distinct query and sort are kept once they're found, so
+    paging through a query only costs a binary search for its search_after. that
+    keeps the mock's own time out of what a benchmark measures
+    '''
+
+    uid_type = 'web_article'
+
+    def __init__(self, entities):
+        self.entities = {entity['$']['id']: entity for entity in entities}
+        self.articles = [entity for entity in entities if 'web_article_title' in entity]
+        self.words = {}
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def _text(self, entity, field):
+        if field in ('_all', '*'):
+            return ' '.join(value for value in entity.values() if isinstance(value, str)).lower()
+        return str(entity.get(field, '')).lower()
+
+    def _words(self, entity, field):
+        key = (entity['$']['id'], field)
+        if key not in self.words:
+            self.words[key] = set(self._terms(self._text(entity, field)))
+
+        return self.words[key]
+
+    def _terms(self, text):
+        return [term for term in re.findall(r'[a-z0-9]+', text.lower()) if term not in ('or', 'and', 'not')]
+
+    def _values(self, entity, field):
+        value = entity.get(field[:-len('.raw')] if field.endswith('.raw') else field)
+        return value if isinstance(value, list) else [value]
+
+    def _clauses(self, body, key):
+        '''bool clauses can be a single query or a list of them'''
+        clauses = body.get(key, [])
+        return clauses if isinstance(clauses, list) else [clauses]
+
+    def match(self, query, entity):
+        '''return True if entity matches the elasticsearch query'''
+        (kind, body), = query.items()
+
+        if kind == 'match_all':
+            return True
+        if kind == 'constant_score':
+            return self.match(body['filter'], entity)
+        if kind == 'bool':
+            required = self._clauses(body, 'must') + self._clauses(body, 'filter')
+            should = self._clauses(body, 'should')
+            return all(self.match(q, entity) for q in required) \
+                and not any(self.match(q, entity) for q in self._clauses(body, 'must_not')) \
+                and (not should or required or any(self.match(q, entity) for q in should))
+        if kind in ('match', 'query_string'):
+            if kind == 'match':
+                (field, text), = body.items()
+                text = text['query'] if isinstance(text, dict) else text
+            else:
+                field, text = body.get('default_field', '_all'), body['query']
+            words = self._words(entity, field)
+            return any(term in words for term in self._terms(text))
+        if kind == 'term':
+            (field, value), = body.items()
+            value = value['value'] if isinstance(value, dict) else value
+            return value in self._values(entity, field)
+        if kind == 'terms':
+            (field, values), = body.items()
+            return any(value in values for value in self._values(entity, field))
+        if kind == 'exists':
+            return body['field'] in entity
+        if kind == 'range':
+            (field, bounds), = body.items()
+            if field not in entity:
+                return False
+            checks = {'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b,
+                      'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b}
+            return all(checks[op](entity[field], bound) for op, bound in bounds.items() if op in checks)
+
+        raise ValueError('the mock doesn\'t support "{}" queries'.format(kind))
+
+    def _sort_fields(self, sort):
+        '''return a list of (field, descending) from an elasticsearch sort, ignoring _score'''
+        fields = []
+        for spec in sort:
+            field, options = (spec, {}) if isinstance(spec, str) else next(iter(spec.items()))
+            order = options if isinstance(options, str) else options.get('order', 'asc')
+            if field != '_score':
+                fields.append((field, order == 'desc'))
+
+        return fields or [('_uid', True)]
+
+    def _sort_values(self, entity, fields):
+        values = []
+        for field, descending in fields:
+            if field == '_uid':
+                values.append('{}#{}'.format(self.uid_type, entity['$']['id']))
+            else:
+                values.append(entity.get(field, MISSING_DESC if descending else MISSING_ASC))
+
+        return values
+
+    def _compare(self, fields):
+        def compare(a, b):
+            for (field, descending), x, y in zip(fields, a, b):
+                if x != y:
+                    return (-1 if x > y else 1) if descending else (-1 if x < y else 1)
+            return 0
+
+        return compare
+
+    def _search(self, query, sort):
+        '''
+        return tuple formatted (sort key, sort keys, sort values, entities) for the
+        entities matching query, in sort order. sort key wraps sort values for bisect
+        '''
+        key = json.dumps([query, sort], sort_keys=True)
+        with self.lock:
+            if key not in self.results:
+                fields = self._sort_fields(sort)
+                sort_key = cmp_to_key(self._compare(fields))
+                hits = [(self._sort_values(entity, fields), entity) for entity in self.articles if self.match(query, entity)]
+                hits.sort(key=lambda hit: sort_key(hit[0]))
+                self.results[key] = (sort_key, [sort_key(sort) for sort, entity in hits],
+                                     [sort for sort, entity in hits], [entity for sort, entity in hits])
+
+        return self.results[key]
+
+    def _project(self, entity, source):
+        '''entity with just the fields in the "_source" includes, if there are any'''
+        includes = source.get('includes') if isinstance(source, dict) else source
+        if not isinstance(includes, list):
+            return entity
+
+        return {key: value for key, value in entity.items() if key in includes}
+
+    def _follow(self, entity, follow):
+        '''entity with each edge in follow merged with the entity it points to, where there is one'''
+        followed = dict(entity)
+        for edge in follow:
+            if isinstance(entity.get(edge), list):
+                followed[edge] = [dict(self.entities.get(item.get('$id'), {}), **item) for item in entity[edge]]
+
+        return followed
+
+    def search(self, params):
+        request = params['elasticsearchRequest']
+        sort_key, keys, sorts, entities = self._search(request.get('query', {'match_all': {}}),
+                                                 request.get('sort', [{'_uid': 'desc'}]))
+
+        if request.get('search_after'):
+            start = bisect.bisect_right(keys, sort_key(request['search_after']))
+        else:
+            start = request.get('from', 0)
+        end = start + request.get('size', 10)
+        page = list(zip(sorts[start:end], entities[start:end]))
+        found = len(entities)
+
+        return {
+            'found': found,
+            'entities': [self._follow(self._project(entity, request.get('_source')), params.get('follow') or [])
+                         for sort, entity in page],
+            'hits': {'total': found, 'hits': [{'_id': entity['$']['id'], 'sort': sort} for sort, entity in page]}
+        }
+
+    def get_batch(self, params):
+        return [self.entities[id] for id in params['batchRequest']['Ids'] if id in self.entities]
+
+
+class MockCaaSServer(ThreadingHTTPServer):
+    '''
+    http server for a MockCaaS, answering POST /search and POST /batch with the
+    json bodies that CaaSClient sends. start() serves from a background thread,
+    port 0 picks a free port, and url is where the server ended up.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, caas, host='localhost', port=0, latency=0.0, jitter=0.0, throttle_rate=0.0, seed=0):
+        super().__init__((host, port), MockCaaSHandler)
+        self.caas = caas
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def delay(self):
+        sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+    def throttled(self):
+        return self.rng.random() < self.throttle_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockCaaSHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes, so small responses would otherwise
+    # wait on the client's delayed ack, adding ~40ms that CaaS doesn't
+    disable_nagle_algorithm = True
+
+    def _respond(self, code, body, entities=0):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Entities', str(entities))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.server.delay()
+
+        if self.server.throttled():
+            return self._respond(429, {'message': 'Too Many Requests'})
+
+        try:
+            if self.path == '/search':
+                body = self.server.caas.search(params)
+                self._respond(200, body, len(body['entities']))
+            elif self.path == '/batch':
+                body = self.server.caas.get_batch(params)
+                self._respond(200, body, len(body))
+            else:
+                self._respond(404, {'message': 'no such endpoint {}'.format(self.path)})
+        except (KeyError, ValueError) as e:
+            self._respond(400, {'message': str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockEntityClient:
+    '''
+    stands in for Time's EntityServiceClient, sending search() and get_batch() to
+    a MockCaaSServer over one keep-alive session. the round trip time of every
+    request and the number of entities it returned are recorded in timings and entities
+    '''
+
+    timeout = 30
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.x_api_key = None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=64)
+        self.session.mount('http://', adapter)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = {'search': [], 'get_batch': []}
+        self.entities = {'search': 0, 'get_batch': 0}
+
+    def _post(self, kind, path, params, stream=False):
+        start = monotonic()
+        response = self.session.post(self.url + path, json=params, timeout=self.timeout, stream=stream)
+        elapsed = monotonic() - start
+
+        with self.lock:
+            self.timings[kind].append(elapsed)
+            self.entities[kind] += int(response.headers.get('X-Entities', 0))
+
+        return response
+
+    def search(self, params, stream=False):
+        '''with stream=True the body is left on the connection, and the timing only covers the headers'''
+        return self._post('search', '/search', params, stream=stream)
+
+    def get_batch(self, params):
+        return self._post('get_batch', '/batch', params)
+
+
+def capture_args():
+    parser = argparse.ArgumentParser(description='serve mock CaaS search and get_batch endpoints')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--entities', type=int, default=10000, help='how many articles to generate')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated articles')
+    parser.add_argument('--fixture', help='json file with a list of entities to serve instead of generated ones')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay every response by')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds of random delay')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests to answer with a 429')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = capture_args()
+    entities = load_fixture(args.fixture) if args.fixture else generate_entities(args.entities, args.seed)
+    server = MockCaaSServer(MockCaaS(entities), args.host, args.port, args.latency, args.jitter, args.throttle_rate)
+
+    print('serving {} entities at {}'.format(len(entities), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,88 @@
+# adaptive token bucket for pacing requests to CaaS
+# 10/18/26
+# updated 10/18/26
+
+import threading
+from time import sleep, monotonic
+
+
+class AdaptiveRateLimiter:
+    '''
+    token bucket that every request a CaaSClient sends has to get a token from,
+    including requests sent concurrently from AsyncCaaSClient's thread pool.
+
+    the rate isn't fixed, it goes looking for the highest rate CaaS accepts:
+    every successful response adds increase requests/second, a response slower
+    than target_latency takes 10% off, and a throttled (429) or failed (5xx)
+    response halves it. the rate always stays between min_rate and max_rate.
+
+    requests in flight together tend to get throttled together, so the rate is cut
+    at most once every cooldown seconds, rather than once for every one of them.
+    '''
+
+    rate = 5.0
+    min_rate = 0.5
+    max_rate = 50.0
+    increase = 0.1
+    target_latency = 5.0
+    cooldown = 1.0
+
+    def __init__(self, rate=rate, min_rate=min_rate, max_rate=max_rate, increase=increase,
+                 target_latency=target_latency, cooldown=cooldown, logger=None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.updated = monotonic()
+        self.last_decrease = None
+
+    def _set_rate(self, rate):
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+
+    def _decrease(self, factor):
+        '''multiply the rate by factor, unless it was already cut within the cooldown. returns True if it was cut'''
+        now = monotonic()
+        if self.last_decrease is not None and now - self.last_decrease < self.cooldown:
+            return False
+
+        self.last_decrease = now
+        self._set_rate(self.rate * factor)
+        return True
+
+    def acquire(self):
+        '''
+        take a token, sleeping until one is available. tokens are reserved under the
+        lock and waited for outside of it, so concurrent callers queue up in order
+        instead of all waking at once. returns how long the caller waited.
+        '''
+        with self.lock:
+            now = monotonic()
+            # allow a burst of at most one second's worth of requests
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
+
+        return wait
+
+    def on_success(self, latency):
+        with self.lock:
+            if latency > self.target_latency:
+                self._decrease(0.9)
+            else:
+                self._set_rate(self.rate + self.increase)
+
+    def on_throttle(self):
+        with self.lock:
+            decreased = self._decrease(0.5)
+
+        if decreased and self.logger:
+            self.logger.warning('CaaS is pushing back, slowing down to {:.2f} requests per second'.format(self.rate))
@@ -1,16 +1,212 @@
-# scrap web pages for article content
+#!/usr/local/bin/python3
+# scrape web pages for article content
 # 7/10/18
-# updated 7/10/18
+# updated 10/18/26
 
+'''
+scrape the <p> text of every url in a list and write it to a csv file:
+
+python3 scrape.py ../output/query_results.csv article_content.csv
+
+the input can be a csv file with a url column (like a caas_query.py export) or
+a text file with one url per line. pages are fetched concurrently over a pool of
+keep-alive connections, and kept in an on-disk cache along with their ETag and
+Last-Modified headers, so scraping the same urls again only re-downloads the
+pages that changed.
+'''
+
+import csv
+import sqlite3
+import logging
+import argparse
+import threading
 import requests
+import lxml.html
+from time import time
 from bs4 import BeautifulSoup
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from .url_index import read_csv_urls
+except ImportError:
+    from url_index import read_csv_urls
+
+
+class ResponseCache:
+    '''
+    sqlite backed cache of fetched pages keyed by url, storing the body along with
+    the validators needed to make a conditional request for it next time.
+    the connection is shared between threads, so every call goes through self.lock
+    '''
+
+    path = 'scrape_cache.sqlite'
+
+    def __init__(self, path=path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pages '
+                          '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, stored REAL, body TEXT)')
+        self.conn.commit()
+
+    def get(self, url):
+        '''return a dict with the etag, last_modified and body stored for url, or None'''
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified, body FROM pages WHERE url = ?', (url,)).fetchone()
+
+        return dict(zip(['etag', 'last_modified', 'body'], row)) if row else None
+
+    def put(self, url, etag, last_modified, body):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO pages (url, etag, last_modified, stored, body) VALUES (?, ?, ?, ?, ?)',
+                              (url, etag, last_modified, time(), body))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class Scraper:
+    '''
+    fetches pages with up to max_workers requests in flight, all sharing one
+    requests.Session whose connection pool is sized to match. pages in the cache
+    are revalidated with If-None-Match/If-Modified-Since, and a 304 is served
+    from the cache.
+    '''
+
+    max_workers = 8
+    timeout = 30
+    user_agent = 'Mozilla/5.0 (compatible; caas-scraper)'
+
+    def __init__(self, cache=None, max_workers=max_workers, logger=None):
+        self.cache = cache
+        self.max_workers = max_workers
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.session = self._init_session()
+
+    def _init_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = self.user_agent
+
+        return session
+
+    def _conditional_headers(self, cached):
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        return headers
+
+    def fetch(self, url):
+        '''return tuple formatted (status, html). status is 'cached' if the cached copy is still current'''
+        cached = self.cache.get(url) if self.cache else None
+        response = self.session.get(url, headers=self._conditional_headers(cached), timeout=self.timeout)
+
+        if response.status_code == 304 and cached:
+            return 'cached', cached['body']
+
+        response.raise_for_status()
+        if self.cache:
+            self.cache.put(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.text)
+
+        return 'fetched', response.text
+
+    def scrape(self, urls):
+        '''
+        yield a tuple formatted (url, status, paragraphs) for every url, in the order
+        they finish. a url that couldn't be fetched has status 'error' and no paragraphs.
+
+        urls are submitted twice max_workers at a time, topping the window back up as
+        pages finish, and each page is let go once it's been yielded, so memory doesn't
+        grow with the number of urls
+        '''
+        urls = iter(urls)
+        window = 2 * self.max_workers
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            while True:
+                for url in islice(urls, window - len(futures)):
+                    futures[executor.submit(self.fetch, url)] = url
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = futures.pop(future)
+                    try:
+                        status, html = future.result()
+                    except requests.RequestException as e:
+                        self.logger.warning('failed to fetch {}: {}'.format(url, e))
+                        yield url, 'error', []
+                        continue
+
+                    yield url, status, extract_paragraphs(html)
+
+    def close(self):
+        self.session.close()
+
+
+def extract_paragraphs(html):
+    '''
+    return the text of every <p> tag in html. lxml's parser is used directly
+    since it's much faster, falling back to BeautifulSoup for markup it can't handle
+    '''
+    try:
+        doc = lxml.html.document_fromstring(html)
+        ps = [p.text_content() for p in doc.iter('p')]
+    except (lxml.etree.ParserError, ValueError):
+        ps = [p.get_text() for p in BeautifulSoup(html, 'html.parser').find_all('p')]
+
+    return [p.strip() for p in ps if p.strip()]
+
+
+def read_urls(path, column='url'):
+    '''read urls from a column of a csv file, or one per line from any other file'''
+    if path.endswith('.csv'):
+        urls = read_csv_urls(path, column)
+    else:
+        with open(path) as url_file:
+            urls = [line for line in url_file]
+
+    # drop blanks and repeats, keeping the original order
+    return list(dict.fromkeys(url.strip() for url in urls if url.strip()))
+
+
+def capture_args():
+    parser = argparse.ArgumentParser(description='scrape the <p> text of a list of urls to a csv file')
+    parser.add_argument('urls', help='csv file with a url column, or a text file with one url per line')
+    parser.add_argument('output', help='csv file to write url, status and content to')
+    parser.add_argument('--column', default='url', help='name of the url column in a csv input file')
+    parser.add_argument('--workers', type=int, default=Scraper.max_workers, help='how many pages to fetch at once')
+    parser.add_argument('--cache', default=ResponseCache.path, help='sqlite file to cache fetched pages in')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = capture_args()
+    urls = read_urls(args.urls, args.column)
+    cache = ResponseCache(args.cache)
+    scraper = Scraper(cache=cache, max_workers=args.workers)
 
+    logging.info('scraping {} urls with {} workers'.format(len(urls), args.workers))
+    statuses = {}
+    with open(args.output, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['url', 'status', 'content'])
 
-url = 'http://instyle.com/hair/find-perfect-cut-your-face-shape/'
-page = requests.get(url)
-soup = BeautifulSoup(page.text, 'lxml')
-ps = soup.find_all('p')
-print('# of p tags found: {}'.format(len(ps)))
+        for url, status, paragraphs in scraper.scrape(urls):
+            statuses[status] = statuses.get(status, 0) + 1
+            writer.writerow([url, status, '\n'.join(paragraphs)])
 
-for p in ps:
-    print(p.prettify())
+    logging.info('done: {}'.format(statuses))
+    scraper.close()
+    cache.close()
@@ -0,0 +1,110 @@
+# output sinks for caas_query.py results
+# 10/18/26
+# updated 10/18/26
+
+import csv
+
+
+class CsvSink:
+    '''
+    appends records to a csv file, one page at a time. records are expected to have
+    a row() method returning their values in the order of fieldnames. the file is opened once
+    and flushed after every page, so tell() always reflects what's on disk.
+    the nlp categories end up as stringified dicts.
+    '''
+
+    extension = '.csv'
+
+    def __init__(self, path, fieldnames):
+        self.path = path
+        self.fieldnames = fieldnames
+        self.csvfile = open(path, 'a', newline='')
+        self.writer = csv.writer(self.csvfile)
+
+    @staticmethod
+    def init_file(path, fieldnames):
+        '''create a new csv file and write headers to it'''
+        with open(path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+
+    def write(self, records):
+        self.writer.writerows(record.row() for record in records)
+        self.csvfile.flush()
+
+    def tell(self):
+        return self.csvfile.tell()
+
+    def close(self):
+        self.csvfile.close()
+
+
+class ParquetSink:
+    '''
+    streams records to a parquet file, writing one row group per page. the nlp
+    categories are stored as typed struct columns and sort_id as a list of strings,
+    so exports can be loaded with column pruning instead of re-parsing a csv.
+
+    pyarrow is only needed when writing parquet, so it's imported here rather than
+    at the top of the module. the file's footer is written by close(), so an
+    interrupted run leaves an unreadable file, and there's nothing to resume from.
+    '''
+
+    extension = '.parquet'
+
+    def __init__(self, path, fieldnames):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.path = path
+        self.fieldnames = fieldnames
+        self.pa = pyarrow
+        self.schema = self._init_schema()
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.rows = 0
+
+    @staticmethod
+    def init_file(path, fieldnames):
+        '''nothing to do, the parquet writer creates the file when it's opened'''
+        pass
+
+    def _init_schema(self):
+        pa = self.pa
+        types = {
+            'sort_id': pa.list_(pa.string()),
+            'gnlp_categories': pa.struct([('name', pa.string()), ('confidence', pa.float64())]),
+            'wnlp_categories': pa.struct([('label', pa.string()), ('score', pa.float64())])
+        }
+
+        return pa.schema([(name, types.get(name, pa.string())) for name in self.fieldnames])
+
+    def _column(self, records, name):
+        values = [getattr(record, name) for record in records]
+
+        if name == 'sort_id':
+            return [[str(sort) for sort in value] for value in values]
+        elif name.endswith('_categories'):
+            # records without nlp data have empty dicts, which are stored as nulls
+            return [value or None for value in values]
+        else:
+            return [str(value) if value is not None else None for value in values]
+
+    def write(self, records):
+        records = list(records)
+        if not records:
+            return
+
+        columns = {name: self._column(records, name) for name in self.fieldnames}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+        self.rows += len(records)
+
+    def tell(self):
+        return self.rows
+
+    def close(self):
+        self.writer.close()
+
+
+def get_sink(path):
+    '''return the sink class to use for path, going by its file extension'''
+    return ParquetSink if path.endswith(ParquetSink.extension) else CsvSink
@@ -0,0 +1,148 @@
+#!/usr/local/bin/python3
+# memory-mapped index of canonicalised urls, for excluding urls already in the training corpus
+# 10/18/26
+# updated 10/18/26
+
+'''
+build an index from the url column of a csv file with:
+
+python3 url_index.py corpus.csv corpus_urls.idx
+
+urls are canonicalised before they're hashed, so http/https, a leading "www.",
+a trailing slash, the order of query params and any fragment don't matter.
+the index is a hash table of 64 bit url hashes written straight to disk, so
+loading it is just mapping the file, and a lookup is a hash and a probe or two.
+'''
+
+import os
+import csv
+import sys
+import mmap
+import struct
+import hashlib
+from array import array
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+
+def canonicalise(url):
+    '''
+    reduce url to host/path?query, lowercasing the host and sorting the query params.
+    a url urlsplit can't parse, like one with a broken ipv6 host, is just stripped and
+    lowercased, so it only matches itself instead of stopping a lookup or a build
+    '''
+    try:
+        parts = urlsplit(url.strip() if '//' in url else '//' + url.strip())
+    except ValueError:
+        return url.strip().lower()
+    host = parts.netloc.lower()
+    host = host[4:] if host.startswith('www.') else host
+    path = parts.path.rstrip('/')
+    query = urlencode(sorted(parse_qsl(parts.query)))
+
+    return '{}{}?{}'.format(host, path, query) if query else host + path
+
+
+def hash_url(url):
+    '''64 bit hash of the canonical url. 0 marks an empty slot in the table, so it's never returned'''
+    digest = hashlib.blake2b(canonicalise(url).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class UrlIndex:
+    '''
+    read-only set of urls backed by a memory-mapped file written by build().
+    supports "url in index" and len(index)
+    '''
+
+    magic = b'URLIDX01'
+    header = struct.Struct('<8sQQ')
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.capacity, self.count = self.header.unpack_from(self.mm)
+        if magic != self.magic:
+            raise ValueError('{} is not a url index'.format(path))
+
+        self.mask = self.capacity - 1
+        self.table = memoryview(self.mm)[self.header.size:].cast('Q')
+
+    @classmethod
+    def build(cls, urls, path):
+        '''
+        write an index of urls to path. the table is a power of 2 at least twice the
+        number of urls, so linear probing stays short. it's written to a temporary file
+        first and moved into place, so a reader never sees a half written index
+        '''
+        hashes = {hash_url(url) for url in urls if url}
+        capacity = 8
+        while capacity < 2 * len(hashes):
+            capacity *= 2
+
+        table = array('Q', bytes(8 * capacity))
+        for url_hash in hashes:
+            slot = url_hash & (capacity - 1)
+            while table[slot]:
+                slot = (slot + 1) & (capacity - 1)
+            table[slot] = url_hash
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(cls.header.pack(cls.magic, capacity, len(hashes)))
+            table.tofile(index_file)
+        os.replace(tmp_path, path)
+
+        return cls(path)
+
+    def __contains__(self, url):
+        if not url:
+            return False
+
+        url_hash = hash_url(url)
+        slot = url_hash & self.mask
+        while self.table[slot]:
+            if self.table[slot] == url_hash:
+                return True
+            slot = (slot + 1) & self.mask
+
+        return False
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.table.release()
+        self.mm.close()
+
+
+def read_csv_urls(csv_path, column):
+    '''yield the values of a column from a csv file, column can be an index or a header name'''
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        if not isinstance(column, int):
+            column = next(reader).index(column)
+
+        for row in reader:
+            if len(row) > column:
+                yield row[column]
+
+
+def load_index(csv_path, index_path, column):
+    '''
+    return the index at index_path, building it from csv_path first if
+    it doesn't exist yet or is older than the csv file
+    '''
+    if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(csv_path):
+        return UrlIndex.build(read_csv_urls(csv_path, column), index_path)
+
+    return UrlIndex(index_path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        raise SystemExit('usage: python3 url_index.py urls.csv urls.idx [url column name]')
+
+    column = sys.argv[3] if len(sys.argv) == 4 else 'url'
+    index = UrlIndex.build(read_csv_urls(sys.argv[1], column), sys.argv[2])
+    print('indexed {} urls in {}'.format(len(index), sys.argv[2]))
@@ -0,0 +1,53 @@
+# high-water marks for incremental caas_query.py runs
+# 10/18/26
+# updated 10/18/26
+
+import json
+import sqlite3
+from time import time
+
+
+class Watermarks:
+    '''
+    sqlite file kept next to an output file that records, for every query exported
+    into it incrementally, the latest "$date" the query matched when it last finished.
+    the next incremental run of that query only has to search from there on.
+
+    a watermark is only set once its run has been merged into the output file, so
+    a failed run is simply searched again from the old watermark.
+    '''
+
+    suffix = '.watermark'
+
+    def __init__(self, output_file):
+        self.path = output_file + self.suffix
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS watermarks (query TEXT PRIMARY KEY, date INTEGER, updated REAL)')
+        self.conn.commit()
+
+    @staticmethod
+    def key(search_params):
+        '''identify a query by what it matches, ignoring the fields it returns and the edges it follows'''
+        return json.dumps({'type': search_params.get('type'), 'provider': search_params.get('provider'),
+                           'query': search_params['elasticsearchRequest'].get('query')}, sort_keys=True)
+
+    def get(self, search_params):
+        '''the watermark of the query, or None if it hasn't been exported incrementally yet'''
+        row = self.conn.execute('SELECT date FROM watermarks WHERE query = ?', (self.key(search_params),)).fetchone()
+        return row[0] if row else None
+
+    def set(self, search_params, date):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO watermarks (query, date, updated) VALUES (?, ?, ?)',
+                              (self.key(search_params), date, time()))
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM watermarks').fetchone()[0]
+
+    def clear(self):
+        '''forget every watermark, e.g. when the output file they belong to is gone'''
+        with self.conn:
+            self.conn.execute('DELETE FROM watermarks')
+
+    def close(self):
+        self.conn.close()